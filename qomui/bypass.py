@@ -2,104 +2,485 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import json
+import errno
+import shlex
 import logging
-from subprocess import check_call, Popen, CalledProcessError
-from qomui import firewall
+import threading
+import configparser
+from subprocess import check_call, Popen, CalledProcessError, TimeoutExpired
+from qomui import firewall, netlink, dnscache, nft
 
+rootdir = "/usr/share/qomui"
 cgroup_path = "/sys/fs/cgroup/net_cls/bypass_qomui"
+cgroup_v2_root = "/sys/fs/cgroup"
+cgroup_name = "bypass_qomui"
 cls_id = "0x00110011"
+fwmark = 11
+connmark_mask = 0xffff
+route_table = 11
+dns_port = 5354
+default_group = "default"
 default_interface = None
+groups = {}
+exec_cache = {}
+launch_check = 0.5
+field_codes = ["%f", "%F", "%u", "%U", "%d", "%D", "%n", "%N", "%v", "%m"]
 
-def create_cgroup(user, group, default_interface, default_gateway):
-    
-    cleanup = delete_cgroup(default_interface)
-    
-    cgroup_iptables = [["-t", "mangle", "-A", "OUTPUT", "-m", "cgroup", 
-                       "--cgroup", "0x00110011", "-j", "MARK", "--set-mark", "11"],
-                        ["-t", "nat", "-A", "POSTROUTING", "-m", "cgroup", 
-                       "--cgroup", "0x00110011", "-o", "%s" %default_interface , "-j", "MASQUERADE"],
-                        ["-I", "OUTPUT", "1", "-m", "cgroup", 
-                       "--cgroup", "0x00110011", "-j", "ACCEPT"],
-                        ["-I", "INPUT", "1", "-m", "cgroup", 
-                       "--cgroup", "0x00110011", "-j", "ACCEPT"],
-                        ["-t", "nat", "-A", "OUTPUT", "-m", "cgroup", "--cgroup", 
-                         "0x00110011", "-p", "tcp", "--dport", "53", "-j", "REDIRECT", "--to-ports", "5354"],
-                        ["-t", "nat", "-A", "OUTPUT", "-m", "cgroup", "--cgroup", 
-                         "0x00110011", "-p", "udp", "--dport", "53", "-j", "REDIRECT", "--to-ports", "5354"]
-                        ]
-    
-    if not os.path.exists(cgroup_path):
-        os.makedirs(cgroup_path)
-        with open("%s/net_cls.classid" % cgroup_path, 'w') as setcid:
-            setcid.write(cls_id)
+def get_groups():
+    specs = [group_spec({"name" : default_group}, 0)]
+    try:
+        with open("%s/bypass_groups.json" %rootdir, "r") as f:
+            extra = json.load(f)
+    except FileNotFoundError:
+        return specs
+    except json.decoder.JSONDecodeError as e:
+        logging.warning("Could not parse bypass_groups.json: %s" %e)
+        return specs
+
+    if not isinstance(extra, list):
+        logging.warning("bypass_groups.json must contain a list of groups")
+        return specs
+    for index, options in enumerate(extra, 1):
+        try:
+            spec = group_spec(options, index)
+            for other in specs:
+                for key in ("name", "mark", "table", "dns_port", "classid"):
+                    if spec[key] == other[key]:
+                        raise ValueError("%s %s already used by group %s" %(key, spec[key], other["name"]))
+            specs.append(spec)
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.warning("Skipping bypass group %s: %s" %(index, e))
+    return specs
+
+def group_spec(options, index):
+    name = options["name"] if "name" in options else None
+    if not isinstance(name, str) or re.match(r"^[a-z0-9_]{1,20}$", name) is None:
+        raise ValueError("invalid name %s" %name)
+    spec = {"name" : name,
+            "mark" : int(options.get("mark", fwmark + index)),
+            "table" : int(options.get("table", route_table + index)),
+            "dns_port" : int(options.get("dns_port", dns_port + index)),
+            "classid" : "0x%08x" %(int(cls_id, 16) + index),
+            "interface" : options.get("interface", None),
+            "gateway" : options.get("gateway", None),
+            "dns_cache_size" : int(options.get("dns_cache_size", dnscache.cache_size)),
+            "dns_neg_ttl" : int(options.get("dns_neg_ttl", dnscache.neg_ttl))
+            }
+    if not 0 < spec["mark"] <= connmark_mask or not 0 < spec["table"] < 253 or not 0 < spec["dns_port"] < 65536:
+        raise ValueError("mark, table or dns_port out of range")
+    if spec["dns_cache_size"] < 0 or spec["dns_neg_ttl"] < 0:
+        raise ValueError("negative dns cache settings")
+    for key in ("interface", "gateway"):
+        if spec[key] is not None and not isinstance(spec[key], str):
+            raise ValueError("invalid %s" %key)
+    return spec
+
+def group_cgroup(spec):
+    if spec["name"] == default_group:
+        return cgroup_name
+    return "bypass_%s" %spec["name"]
+
+def cgroup_version():
+    if os.path.isdir(os.path.dirname(cgroup_path)):
+        return 1
+    elif os.path.exists("%s/cgroup.controllers" %cgroup_v2_root):
+        return 2
+    return 1
+
+def cgroup_dir(spec=None):
+    name = cgroup_name if spec is None else group_cgroup(spec)
+    if cgroup_version() == 2:
+        return "%s/%s" %(cgroup_v2_root, name)
+    return "%s/%s" %(os.path.dirname(cgroup_path), name)
+
+def cgroup_match(spec):
+    if cgroup_version() == 2:
+        return ["-m", "cgroup", "--path", group_cgroup(spec)]
+    return ["-m", "cgroup", "--cgroup", spec["classid"]]
+
+def cgroup_rules(spec, interface, action="-A"):
+    match = cgroup_match(spec)
+    port = str(spec["dns_port"])
+    return [["-t", "mangle", action, "OUTPUT"] + match + ["-j", "MARK", "--set-mark", str(spec["mark"])],
+            masquerade_rule(spec, interface, action=action),
+            [action, firewall.allow_chain] + match + ["-j", "ACCEPT"],
+            ["-t", "nat", action, "OUTPUT"] + match +
+            ["-p", "tcp", "--dport", "53", "-j", "REDIRECT", "--to-ports", port],
+            ["-t", "nat", action, "OUTPUT"] + match +
+            ["-p", "udp", "--dport", "53", "-j", "REDIRECT", "--to-ports", port]
+            ] + acct_rules(spec, action=action)
+
+def acct_rules(spec, action="-A"):
+    #rules without a target only count - replies are recognized by their connmark
+    #the mask leaves the upper connmark bits to other tools
+    mark = "0x%x/0x%x" %(spec["mark"], connmark_mask)
+    return [["-t", "mangle", action, "OUTPUT"] + cgroup_match(spec) + ["-j", "CONNMARK", "--set-xmark", mark],
+            ["-t", "mangle", action, "OUTPUT"] + cgroup_match(spec) + 
+            ["-m", "comment", "--comment", "qomui-acct %s tx" %spec["name"]],
+            ["-t", "mangle", action, "INPUT", "-m", "connmark", "--mark", mark,
+             "-m", "comment", "--comment", "qomui-acct %s rx" %spec["name"]]
+            ]
+
+def app_rule(spec, app, action="-A"):
+    return ["-t", "mangle", action, "OUTPUT", "-m", "cgroup", "--path", "%s/%s" %(group_cgroup(spec), app),
+            "-m", "comment", "--comment", "qomui-acct %s/%s tx" %(spec["name"], app)]
+
+def app_slug(app):
+    return re.sub(r"[^a-z0-9_]", "_", app.lower())[:32]
+
+def masquerade_rule(spec, interface, action="-A"):
+    return (["-t", "nat", action, "POSTROUTING"] + cgroup_match(spec) +
+            ["-o", "%s" %interface , "-j", "MASQUERADE"])
+
+def group_route(spec, default_interface, default_gateway):
+    #groups without their own interface follow the physical default route
+    if spec["interface"] is None:
+        return default_interface, spec["gateway"] or default_gateway
+    return spec["interface"], spec["gateway"]
+
+def route_msgs(spec, interface, gateway):
+    if gateway is not None:
+        return [netlink.route_msg("add", "default", gateway=gateway, table=spec["table"])]
+    return [netlink.route_msg("add", "default", dev=interface, table=spec["table"])]
+
+def make_cgroup(spec, user, group):
+    path = cgroup_dir(spec)
+    if cgroup_version() == 2:
+        #unified hierarchy - sockets are matched by cgroup path, no classid needed
+        os.makedirs(path, exist_ok=True)
+        return
+    elif not os.path.exists(path):
+        os.makedirs(path)
+        with open("%s/net_cls.classid" % path, 'w') as setcid:
+            setcid.write(spec["classid"])
             setcid.close()
-    
-    try: 
-        check_call(["ip", "route", "show", "table", "bypass_qomui"])
-        logging.debug("No routing table added - table bypass_qomui already exists")
-    except CalledProcessError:
-        with open("/etc/iproute2/rt_tables", "a") as rt_tables:
-            rt_tables.write("11 bypass_qomui\n")
-        logging.debug("Created new routing table - bypass_qomui")
-    
-    for rule in cgroup_iptables:
-        firewall.add_rule(rule)
-    
+    check_call(["cgcreate", "-t", "%s:%s" %(user, group), "-a" "%s:%s" %(user, group),
+                "-g", "net_cls:%s" %group_cgroup(spec)])
+
+def commit_routes(batches):
+    messages = [msg for msgs in batches.values() for msg in msgs]
     try:
-        check_call(["ip", "route", "flush", "table", "bypass_qomui"])
-        check_call(["ip", "rule", "add", "fwmark", "11", "table", "bypass_qomui"])
-        check_call(["ip", "route", "add", "default", "via", "%s" %default_gateway, "table", "bypass_qomui"])
-        check_call(["cgcreate", "-t", "%s:%s" %(user, group), "-a" "%s:%s" %(user, group), "-g", "net_cls:bypass_qomui"])
-    except CalledProcessError:
-        self.logger.error("Configuration of cgroup failed")
-        
-    with open ("/proc/sys/net/ipv4/conf/all/rp_filter", 'w') as rp_edit_all:
-        rp_edit_all.write("2")
-    with open ("/proc/sys/net/ipv4/conf/%s/rp_filter" %default_interface, 'w') as rp_edit_int:
-        rp_edit_int.write("2")
-        
-    logging.info("Succesfully create cgroup to bypass OpenVPN tunnel")
-    
+        netlink.transact(messages, ignore=(errno.EEXIST,))
+        return []
+    except OSError:
+        pass
+    #find out which groups are affected so the others stay untouched
+    failed = []
+    for name, msgs in batches.items():
+        try:
+            netlink.transact(msgs, ignore=(errno.EEXIST,))
+        except (OSError, ValueError) as e:
+            logging.error("Could not configure routing for bypass group %s: %s" %(name, e))
+            failed.append(name)
+    return failed
+
+def create_cgroup(user, group, default_interface, default_gateway):
+    specs = get_groups()
+    wanted = [spec["name"] for spec in specs]
+    for name in [n for n in groups.keys() if n not in wanted]:
+        remove_group(name)
+
+    rules = {}
+    batches = {}
+    new = []
+    stale = []
+    for spec in specs:
+        name = spec["name"]
+        interface, gateway = group_route(spec, default_interface, default_gateway)
+        state = groups.get(name)
+        if state is not None and state["spec"] != spec:
+            remove_group(name)
+            state = None
+        try:
+            if state is None or state["owner"] != (user, group):
+                make_cgroup(spec, user, group)
+            register_table(spec)
+            msgs = route_msgs(spec, interface, gateway)
+        except (OSError, ValueError, CalledProcessError) as e:
+            logging.error("Could not create bypass group %s: %s" %(name, e))
+            continue
+        if state is None:
+            msgs.insert(0, netlink.rule_msg("add", spec["mark"], spec["table"]))
+            new.append(name)
+        else:
+            stale.extend(leave_interface(state, interface))
+        batches[name] = msgs
+        #existing rules are kept - add_rules only adds what is missing on both backends
+        rules[name] = cgroup_rules(spec, interface)
+        groups[name] = {"spec" : spec, "interface" : interface, "gateway" : gateway,
+                        "owner" : (user, group),
+                        "resolver" : state["resolver"] if state is not None else None,
+                        "apps" : state["apps"] if state is not None else set()
+                        }
+
+    for name in commit_routes(batches):
+        #drops the cgroup and whatever part of the routing policy made it in
+        remove_group(name)
+    firewall.add_rules(stale + [rule for name in groups.keys() for rule in rules.get(name, [])])
+    for name, state in groups.items():
+        set_rp_filter(state["interface"], "2")
+        start_resolver(state)
+    set_rp_filter("all", "2")
+
+    if len(new) != 0:
+        logging.info("Succesfully created bypass groups: %s" %", ".join(new))
+
+def reload_rules():
+    #a firewall reload rebuilds the nft table or flushes QOMUI-ALLOW - put the rules of active groups back
+    rules = []
+    for name, state in groups.items():
+        rules.extend(cgroup_rules(state["spec"], state["interface"]))
+        rules.extend(app_rule(state["spec"], app) for app in state["apps"])
+    if firewall.backend == "nftables":
+        #the rebuilt table already holds them - a second transaction would leave them out for a moment
+        rules = [rule for rule in rules if nft.carried(rule) is False]
+    if len(rules) != 0:
+        firewall.add_rules(rules)
+        logging.debug("Bypass: restored firewall rules for %s groups" %len(groups))
+
+def update_gateway(default_interface, default_gateway):
+    batches = {}
+    moved = []
+    for name, state in groups.items():
+        interface, gateway = group_route(state["spec"], default_interface, default_gateway)
+        if (interface, gateway) == (state["interface"], state["gateway"]):
+            continue
+        try:
+            batches[name] = route_msgs(state["spec"], interface, gateway)
+            moved.append((name, interface, gateway))
+        except (OSError, ValueError) as e:
+            logging.error("Could not update route for bypass group %s: %s" %(name, e))
+
+    if len(batches) == 0:
+        logging.debug("Bypass: default route via %s unchanged" %default_gateway)
+        return
+    failed = commit_routes(batches)
+
+    rules = []
+    for name, interface, gateway in moved:
+        if name in failed:
+            continue
+        state = groups[name]
+        if state["interface"] != interface:
+            rules.extend(leave_interface(state, interface))
+            rules.append(masquerade_rule(state["spec"], interface))
+            set_rp_filter(interface, "2")
+        state["interface"] = interface
+        state["gateway"] = gateway
+        logging.info("Bypass: group %s routing via %s on %s" %(name, gateway, interface))
+    firewall.add_rules(rules)
+
+def leave_interface(state, interface):
+    #the NAT rule and rp_filter of the old interface are only removed by name
+    old = state["interface"]
+    if old is None or old == interface:
+        return []
+    if all(other["interface"] != old for other in groups.values() if other is not state):
+        set_rp_filter(old, "1")
+    return [masquerade_rule(state["spec"], old, action="-D")]
+
+def set_rp_filter(interface, value):
     try:
-        dnsmasq = Popen(["dnsmasq", "--port=5354", "--bind-interfaces"])
-        return dnsmasq.pid
-    except CalledProcessError:
-        logging.error("Failed to start dnsmasq for cgroup qomui_bypass")
-        return None
-    
+        with open ("/proc/sys/net/ipv4/conf/%s/rp_filter" %interface, 'w') as rp_edit:
+            rp_edit.write(value)
+    except (FileNotFoundError, PermissionError):
+        logging.debug("Could not set rp_filter for %s" %interface)
+
+def start_resolver(state):
+    #the resolver and its cache live as long as the group does
+    resolver = state["resolver"]
+    if resolver is not None and resolver.alive() is True:
+        return
+    elif resolver is not None:
+        #a serve thread died - free the port before starting over
+        stop_resolver(state)
+    spec = state["spec"]
+    resolver = dnscache.Forwarder(spec["dns_port"], name=spec["name"],
+                                  history="%s/bypass_dns_%s.json" %(rootdir, spec["name"]),
+                                  size=spec["dns_cache_size"], negative_ttl=spec["dns_neg_ttl"])
+    try:
+        resolver.start()
+        state["resolver"] = resolver
+    except OSError as e:
+        logging.error("Failed to start DNS resolver for bypass group %s: %s" %(spec["name"], e))
+
+def stop_resolver(state):
+    resolver = state["resolver"]
+    if resolver is not None:
+        resolver.stop()
+    state["resolver"] = None
+
+def remove_group(name):
+    state = groups.pop(name)
+    spec = state["spec"]
+    #replies of the other groups on this interface still need loose reverse-path checks
+    if state["interface"] is not None and all(other["interface"] != state["interface"] for other in groups.values()):
+        set_rp_filter(state["interface"], "1")
+    try:
+        netlink.transact([netlink.rule_msg("del", spec["mark"], spec["table"])] +
+                         netlink.flush_msgs(spec["table"]), ignore=(errno.ENOENT, errno.ESRCH))
+    except OSError as e:
+        logging.debug("Could not remove routing policy for bypass group %s: %s" %(name, e))
+
+    firewall.add_rules(cgroup_rules(spec, state["interface"], action="-D") + 
+                       [app_rule(spec, app, action="-D") for app in state["apps"]])
+    stop_resolver(state)
+    try:
+        for app in state["apps"]:
+            os.rmdir("%s/%s" %(cgroup_dir(spec), app))
+        os.rmdir(cgroup_dir(spec))
+    except (OSError, FileNotFoundError):
+        logging.debug("Could not delete %s - resource does not exist or is busy" %cgroup_dir(spec))
+    logging.info("Deleted bypass group %s" %name)
+
 def delete_cgroup(default_interface):
-    
-    cgroup_iptables_del = [["-t", "mangle", "-D", "OUTPUT", "-m", "cgroup", 
-                       "--cgroup", "0x00110011", "-j", "MARK", "--set-mark", "11"],
-                        ["-t", "nat", "-D", "POSTROUTING", "-m", "cgroup", 
-                       "--cgroup", "0x00110011", "-o", "%s" %default_interface , "-j", "MASQUERADE"],
-                        ["-D", "OUTPUT", "-m", "cgroup", 
-                       "--cgroup", "0x00110011", "-j", "ACCEPT"],
-                        ["-D", "INPUT", "-m", "cgroup", 
-                       "--cgroup", "0x00110011", "-j", "ACCEPT"],
-                        ["-t", "nat", "-D", "OUTPUT", "-m", "cgroup", "--cgroup", 
-                         "0x00110011", "-p", "tcp", "--dport", "53", "-j", "REDIRECT", "--to-ports", "5354"],
-                        ["-t", "nat", "-D", "OUTPUT", "-m", "cgroup", "--cgroup", 
-                         "0x00110011", "-p", "udp", "--dport", "53", "-j", "REDIRECT", "--to-ports", "5354"]
-                        ]
-                        
-    with open ("/proc/sys/net/ipv4/conf/all/rp_filter", 'w') as rp_edit_all:
-        rp_edit_all.write("1")
-    with open ("/proc/sys/net/ipv4/conf/%s/rp_filter" %default_interface, 'w') as rp_edit_int:
-        rp_edit_int.write("1")
-        
+    set_rp_filter("all", "1")
+    if len(groups) == 0:
+        #clean up after a previous run of the service
+        spec = group_spec({"name" : default_group}, 0)
+        groups[default_group] = {"spec" : spec, "interface" : default_interface,
+                                 "gateway" : None, "owner" : None, "resolver" : None,
+                                 "apps" : set()}
+    for name in list(groups.keys()):
+        remove_group(name)
+
+def register_table(spec):
+    name = "bypass_qomui" if spec["name"] == default_group else "bypass_%s" %spec["name"]
     try:
-        check_call(["ip", "rule", "del", "fwmark", "11", "table", "bypass_qomui"])
-        check_call(["ip", "route", "flush", "table", "bypass_qomui"])
-    except CalledProcessError:
+        with open("/etc/iproute2/rt_tables", "r") as rt_tables:
+            if name in rt_tables.read().split():
+                logging.debug("No routing table added - table %s already exists" %name)
+                return
+    except FileNotFoundError:
         pass
-        
-    for rule in cgroup_iptables_del:
-        firewall.add_rule(rule)
-        
     try:
-        os.rmdir(cgroup_path)
-    except (OSError, FileNotFoundError):
-        logging.debug("Could not delete %s - resource does not exist or is busy" %cgroup_path)
-    
-    logging.info("Deleted cgroup")
+        with open("/etc/iproute2/rt_tables", "a") as rt_tables:
+            rt_tables.write("%s %s\n" %(spec["table"], name))
+        logging.debug("Created new routing table - %s" %name)
+    except (FileNotFoundError, PermissionError):
+        logging.debug("Could not register name for routing table %s" %spec["table"])
+
+def parse_exec(desktop_file):
+    mtime = os.stat(desktop_file).st_mtime_ns
+    try:
+        cached_mtime, argv = exec_cache[desktop_file]
+        if cached_mtime == mtime:
+            return argv
+    except KeyError:
+        pass
+
+    entry = configparser.ConfigParser(interpolation=None, strict=False)
+    entry.optionxform = str
+    entry.read(desktop_file)
+    section = entry["Desktop Entry"]
+    argv = []
+    for arg in shlex.split(section["Exec"]):
+        if arg in field_codes:
+            continue
+        elif arg == "%i":
+            if "Icon" in section:
+                argv.extend(["--icon", section["Icon"]])
+            continue
+        arg = arg.replace("%c", section.get("Name", "")).replace("%k", desktop_file)
+        for code in field_codes:
+            arg = arg.replace(code, "")
+        argv.append(arg.replace("%%", "%"))
+
+    exec_cache[desktop_file] = (mtime, argv)
+    return argv
+
+def join_cgroup(pid, cgroup):
+    with open("%s/cgroup.procs" %cgroup, "w") as cgroup_procs:
+        cgroup_procs.write(str(pid))
+
+def launch(argv, cgroup=None, attach=None, failed=None):
+    #the app has to be inside the cgroup before it execs, or its first children escape the bypass
+    #preexec_fn cannot do the move: it runs python between fork and exec, which can deadlock
+    #in the threaded gui, and on cgroup v2 only the root service may write the child's pid anyway
+    #pass_fds alone cannot make the child wait for that, and the stdlib has no CLONE_INTO_CGROUP -
+    #so a shell waits on a pipe until it has been moved into the cgroup and then execs the app
+    #the pipe is the shell's stdin - dash rejects redirections from fds above 9
+    if cgroup is None:
+        cgroup = cgroup_dir()
+
+    ready, go = os.pipe()
+    script = 'read go; exec </dev/null; [ "$go" = 1 ] && exec "$@"; exit 127'
+    try:
+        proc = Popen(["sh", "-c", script, "sh"] + list(argv), stdin=ready,
+                     start_new_session=True, close_fds=True)
+    finally:
+        os.close(ready)
+
+    moved = False
+    try:
+        if attach is None:
+            #cgroup v1 - the group belongs to the gui user, so it can move its own child
+            join_cgroup(proc.pid, cgroup)
+            moved = True
+        else:
+            #cgroup v2 only lets privileged writers move processes across subtrees
+            moved = attach(proc.pid) is True
+        if moved is True:
+            os.write(go, b"1\n")
+    finally:
+        os.close(go)
+        if moved is False:
+            proc.wait()
+    if moved is False:
+        raise OSError("could not move %s into %s" %(argv[0], cgroup))
+
+    threading.Thread(target=reap, args=(proc, argv[0], failed), daemon=True).start()
+    return proc.pid
+
+def reap(proc, name, failed=None):
+    #a missing or broken executable makes the shell exit right away
+    try:
+        code = proc.wait(timeout=launch_check)
+    except TimeoutExpired:
+        proc.wait()
+        return
+    if code != 0:
+        logging.debug("%s exited with code %s right after launch" %(name, code))
+        if failed is not None:
+            failed(name, code)
+
+def attach_pid(pid, name=default_group, app=None):
+    state = groups[name]
+    path = cgroup_dir(state["spec"])
+    if app is not None and cgroup_version() == 2:
+        #a child cgroup per app still matches the group's path rules and gets its own counter
+        slug = app_slug(app)
+        path = "%s/%s" %(path, slug)
+        os.makedirs(path, exist_ok=True)
+        if slug not in state["apps"]:
+            firewall.add_rules([app_rule(state["spec"], slug)])
+            state["apps"].add(slug)
+    with open("%s/cgroup.procs" %path, "w") as cgroup_procs:
+        cgroup_procs.write(str(pid))
+
+def traffic():
+    if firewall.backend == "nftables":
+        counters = nft.read_counters()
+    else:
+        counters = firewall.read_counters(table="mangle")
+
+    stats = {}
+    for name, state in groups.items():
+        spec = state["spec"]
+        rules = {"tx" : acct_rules(spec)[1], "rx" : acct_rules(spec)[2]}
+        keys = {name : rules}
+        for app in state["apps"]:
+            keys["%s/%s" %(name, app)] = {"tx" : app_rule(spec, app)}
+        for key, key_rules in keys.items():
+            entry = stats.setdefault(key, {})
+            for direction, rule in key_rules.items():
+                comment = rule[rule.index("--comment")+1]
+                if firewall.backend == "nftables":
+                    table, cmd = nft.split_rule(rule)
+                    comment = nft.rule_tag(table, cmd[1], cmd[2:])
+                packets, size = counters.get(comment, (0, 0))
+                entry["%s_packets" %direction] = packets
+                entry["%s_bytes" %direction] = size
+    return stats
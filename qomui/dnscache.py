@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import random
+import socket
+import struct
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+resolv_conf = "/etc/resolv.conf"
+cache_size = 1000
+neg_ttl = 60
+max_ttl = 86400
+history_size = 256
+save_interval = 300
+timeout = 2
+workers = 16
+
+header = struct.Struct("!HHHHHH")
+rr_fixed = struct.Struct("!HHIH")
+
+def skip_name(msg, offset):
+    while True:
+        length = msg[offset]
+        if length == 0:
+            return offset + 1
+        elif length & 0xc0 == 0xc0:
+            return offset + 2
+        offset += length + 1
+
+def read_name(msg, offset):
+    labels = []
+    jumps = 0
+    while True:
+        length = msg[offset]
+        if length == 0:
+            break
+        elif length & 0xc0 == 0xc0:
+            jumps += 1
+            if jumps > 16:
+                raise ValueError("compression loop")
+            offset = struct.unpack_from("!H", msg, offset)[0] & 0x3fff
+            continue
+        labels.append(msg[offset+1:offset+1+length].decode("ascii", "replace"))
+        offset += length + 1
+    return ".".join(labels).lower()
+
+def parse_query(msg):
+    qid, flags, qdcount, ancount, nscount, arcount = header.unpack_from(msg)
+    if qdcount != 1 or flags & 0x8000:
+        raise ValueError("not a single question query")
+    end = skip_name(msg, header.size)
+    qtype, qclass = struct.unpack_from("!HH", msg, end)
+    return qid, (read_name(msg, header.size), qtype, qclass), arcount > 0
+
+def question(msg):
+    #raw question section of a single question message
+    if header.unpack_from(msg)[2] != 1:
+        raise ValueError("not a single question message")
+    return msg[header.size:skip_name(msg, header.size) + 4].lower()
+
+def parse_response(msg):
+    #returns the offsets of all ttl fields, the minimum ttl and whether the answer is negative
+    qid, flags, qdcount, ancount, nscount, arcount = header.unpack_from(msg)
+    offset = header.size
+    for i in range(qdcount):
+        offset = skip_name(msg, offset) + 4
+    ttls = []
+    soa_min = None
+    for section, count in enumerate((ancount, nscount, arcount)):
+        for i in range(count):
+            offset = skip_name(msg, offset)
+            rtype, rclass, ttl, rdlength = rr_fixed.unpack_from(msg, offset)
+            if rtype != 41:
+                ttls.append((offset + 4, ttl))
+            if rtype == 6 and section == 1:
+                soa_min = min(ttl, struct.unpack_from("!I", msg, offset + rr_fixed.size + rdlength - 4)[0])
+            offset += rr_fixed.size + rdlength
+    rcode = flags & 0xf
+    negative = rcode == 3 or (rcode == 0 and ancount == 0)
+    return ttls, negative, soa_min, rcode
+
+def get_nameservers():
+    servers = []
+    try:
+        with open(resolv_conf, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == "nameserver":
+                    servers.append(fields[1])
+    except FileNotFoundError:
+        pass
+    return servers
+
+def build_query(name, qtype):
+    qname = b"".join(struct.pack("!B", len(l)) + l.encode("ascii") for l in name.split(".") if l) + b"\0"
+    #same EDNS buffer size most stub resolvers advertise
+    opt = b"\0" + rr_fixed.pack(41, 1232, 0, 0)
+    return (header.pack(random.randint(0, 65535), 0x0100, 1, 0, 0, 1) + qname + 
+            struct.pack("!HH", qtype, 1) + opt)
+
+def recv_exact(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if len(chunk) == 0:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+class Forwarder(object):
+    def __init__(self, port, name="default", history=None, size=cache_size, negative_ttl=neg_ttl):
+        self.port = port
+        self.name = name
+        self.history_file = history
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.cache = OrderedDict()
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits" : 0, "misses" : 0}
+        self.running = False
+        self.sockets = []
+        self.threads = []
+        self.last_save = time.time()
+
+    def start(self):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sockets = [self.udp, self.tcp]
+        try:
+            #only tcp needs SO_REUSEADDR - on udp it would let another socket share the port
+            self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.udp.bind(("127.0.0.1", self.port))
+            self.tcp.bind(("127.0.0.1", self.port))
+            self.tcp.listen(16)
+        except OSError:
+            #a port taken for tcp only must not stay bound for udp
+            for sock in self.sockets:
+                sock.close()
+            self.sockets = []
+            raise
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.running = True
+        self.threads = [threading.Thread(target=target, daemon=True) for target in (self.serve_udp, self.serve_tcp)]
+        for thread in self.threads + [threading.Thread(target=self.prewarm, daemon=True)]:
+            thread.start()
+        logging.info("DNS: caching forwarder for bypass group %s listening on port %s" %(self.name, self.port))
+
+    def stop(self):
+        self.running = False
+        self.save_history()
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self.sockets = []
+        try:
+            self.pool.shutdown(wait=False)
+        except AttributeError:
+            pass
+
+    def alive(self):
+        return self.running and all(thread.is_alive() for thread in self.threads)
+
+    def serve_udp(self):
+        while self.running:
+            try:
+                query, client = self.udp.recvfrom(4096)
+            except OSError:
+                break
+            try:
+                self.pool.submit(self.answer_udp, query, client)
+            except RuntimeError:
+                break
+
+    def answer_udp(self, query, client):
+        response = self.resolve(query)
+        if response is not None:
+            try:
+                self.udp.sendto(response, client)
+            except OSError:
+                pass
+
+    def serve_tcp(self):
+        while self.running:
+            try:
+                conn, client = self.tcp.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.answer_tcp, args=(conn,), daemon=True).start()
+
+    def answer_tcp(self, conn):
+        try:
+            conn.settimeout(10)
+            while True:
+                length = struct.unpack("!H", recv_exact(conn, 2))[0]
+                response = self.resolve(recv_exact(conn, length), tcp=True)
+                if response is None:
+                    break
+                conn.sendall(struct.pack("!H", len(response)) + response)
+        except (OSError, ConnectionError, struct.error):
+            pass
+        finally:
+            conn.close()
+
+    def resolve(self, query, tcp=False):
+        try:
+            qid, key, edns = parse_query(query)
+        except (ValueError, IndexError, struct.error):
+            return None
+
+        cached = self.lookup(key)
+        #plain udp clients cannot take more than 512 bytes
+        if cached is not None and (tcp is True or edns is True or len(cached) <= 512):
+            return struct.pack("!H", qid) + cached[2:]
+
+        response = self.forward(query, tcp=tcp)
+        if response is not None:
+            self.store(key, response)
+        return response
+
+    def lookup(self, key):
+        with self.lock:
+            try:
+                expiry, stored, response, ttls = self.cache[key]
+            except KeyError:
+                self.stats["misses"] += 1
+                return None
+            now = time.time()
+            if now >= expiry:
+                del self.cache[key]
+                self.stats["misses"] += 1
+                return None
+            self.cache.move_to_end(key)
+            self.stats["hits"] += 1
+
+        elapsed = int(now - stored)
+        response = bytearray(response)
+        for offset, ttl in ttls:
+            struct.pack_into("!I", response, offset, max(ttl - elapsed, 0))
+        return bytes(response)
+
+    def store(self, key, response):
+        try:
+            ttls, negative, soa_min, rcode = parse_response(response)
+        except (ValueError, IndexError, struct.error):
+            return
+        if rcode not in (0, 3):
+            return
+        if negative is True:
+            ttl = self.negative_ttl if soa_min is None else min(soa_min, self.negative_ttl)
+        elif len(ttls) != 0:
+            ttl = min(min(t for o, t in ttls), max_ttl)
+        else:
+            return
+        if ttl <= 0:
+            return
+
+        now = time.time()
+        with self.lock:
+            self.cache[key] = (now + ttl, now, response, ttls)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+            if negative is False:
+                self.recent[key[:2]] = now
+                self.recent.move_to_end(key[:2])
+                while len(self.recent) > history_size:
+                    self.recent.popitem(last=False)
+        if now - self.last_save > save_interval:
+            self.last_save = now
+            threading.Thread(target=self.save_history, daemon=True).start()
+
+    def forward(self, query, tcp=False):
+        upstream_id = random.randint(0, 65535)
+        request = struct.pack("!H", upstream_id) + query[2:]
+        for server in get_nameservers():
+            try:
+                if tcp is False:
+                    response = self.forward_udp(request, server, upstream_id)
+                    #truncated - retry over tcp
+                    if response is not None and header.unpack_from(response)[1] & 0x0200:
+                        response = self.forward_tcp(request, server)
+                else:
+                    response = self.forward_tcp(request, server)
+                if response is not None:
+                    #never cache an answer to a different question
+                    if question(response) != question(request):
+                        raise ValueError("answer does not match the question")
+                    return query[:2] + response[2:]
+            except (OSError, ConnectionError, ValueError, IndexError, struct.error) as e:
+                logging.debug("DNS: upstream %s failed - %s" %(server, e))
+        return None
+
+    def forward_udp(self, request, server, upstream_id):
+        with socket.socket(socket.AF_INET6 if ":" in server else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            #connected, so the kernel drops datagrams from any other source
+            sock.connect((server, 53))
+            sock.send(request)
+            while True:
+                response = sock.recv(65535)
+                if len(response) >= header.size and struct.unpack_from("!H", response)[0] == upstream_id:
+                    return response
+
+    def forward_tcp(self, request, server):
+        family = socket.AF_INET6 if ":" in server else socket.AF_INET
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect((server, 53))
+            sock.sendall(struct.pack("!H", len(request)) + request)
+            length = struct.unpack("!H", recv_exact(sock, 2))[0]
+            return recv_exact(sock, length)
+
+    def prewarm(self):
+        names = self.load_history()
+        for name, qtype in names:
+            if self.running is False:
+                break
+            self.resolve(build_query(name, qtype))
+        if len(names) != 0:
+            logging.debug("DNS: pre-warmed %s names for bypass group %s" %(len(names), self.name))
+
+    def load_history(self):
+        if self.history_file is None:
+            return []
+        try:
+            with open(self.history_file, "r") as f:
+                return [(str(n), int(t)) for n, t in json.load(f)][-history_size:]
+        except (FileNotFoundError, json.decoder.JSONDecodeError, TypeError, ValueError):
+            return []
+
+    def save_history(self):
+        if self.history_file is None:
+            return
+        with self.lock:
+            names = [list(key) for key in self.recent.keys()]
+        if len(names) == 0:
+            return
+        #the names reveal what bypassed apps visited - only root may read them
+        tmp_file = "%s.tmp" %self.history_file
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(names, f)
+            os.replace(tmp_file, self.history_file)
+        except OSError as e:
+            logging.debug("DNS: could not save history - %s" %e)
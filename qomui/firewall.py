@@ -1,19 +1,55 @@
+import os
 import json
 import shlex
+import time
 import logging
-from subprocess import check_call, check_output, CalledProcessError
-from collections import Counter
+import ipaddress
+import threading
+from subprocess import check_call, check_output, CalledProcessError, STDOUT
+from collections import Counter, deque
+from qomui import nft
 
 rootdir = "/usr/share/qomui"
-saved_rules = []
-saved_rules_6 = []
 ip_cmd = ["iptables", "--wait",]
 ip6_cmd = ["ip6tables", "--wait",]
+backend = "iptables"
+restore_cmd = ["iptables-restore", "--wait",]
+restore6_cmd = ["ip6tables-restore", "--wait",]
+save_cmd = ["iptables-save"]
+save6_cmd = ["ip6tables-save"]
+builtin_chains = {"filter" : ["INPUT", "FORWARD", "OUTPUT"],
+                  "nat" : ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"],
+                  "mangle" : ["PREROUTING", "INPUT", "FORWARD", "OUTPUT", "POSTROUTING"],
+                  "raw" : ["PREROUTING", "OUTPUT"],
+                  "security" : ["INPUT", "FORWARD", "OUTPUT"]
+                  }
+qomui_chains = {"INPUT" : "QOMUI-IN", "FORWARD" : "QOMUI-FWD", "OUTPUT" : "QOMUI-OUT"}
+allow_chain = "QOMUI-ALLOW"
+legacy_marker = "%s/firewall_chains_migrated" %rootdir
+ipset_cmd = ["ipset"]
+server_sets = {"inet" : "qomui_servers", "inet6" : "qomui_servers6"}
+listed_servers = set()
+config_cache = {}
+timings = {}
+journal = deque(maxlen=32)
+journal_lock = threading.Lock()
+rule_lists = ["ipv4rules", "ipv6rules", "defaults", "defaultsv6", 
+              "unsecure", "unsecurev6", "allowping"]
 
 def add_rule(rule):
+    if backend == "nftables":
+        return nft.add_rules([rule], family="ipv4")
+    return ipt_rule(rule)
+
+def add_rule_6(rule):
+    if backend == "nftables":
+        return nft.add_rules([rule], family="ipv6")
+    return ipt_rule_6(rule)
+
+def ipt_rule(rule):
     a = 1
     try:
-        check = rule[:]
+        check = list(rule)
         if check[0] == "-A":
             check[0] = "-C"
         elif check[0] == "-I":
@@ -21,6 +57,8 @@ def add_rule(rule):
             check.pop(2)
         elif check[2] == "-A":
             check[2] = "-C"
+        else:
+            raise IndexError
         apply_rule = check_call(ip_cmd + check)
         logging.debug("iptables: %s already exists" %rule)
         a = 0
@@ -29,113 +67,752 @@ def add_rule(rule):
             
     try:
         if a == 1:
-            apply_rule = check_call(ip_cmd + rule)
+            apply_rule = check_call(ip_cmd + list(rule))
             logging.debug("iptables: applied %s" %rule)
+        return True
         
     except CalledProcessError:
-        logging.warning("iptables: failed to apply %s" %rule)
+        log_failure("iptables", rule)
+        return False
     
-def add_rule_6(rule):
+def ipt_rule_6(rule):
     try:
-        apply_rule = check_call(ip6_cmd + rule)
+        apply_rule = check_call(ip6_cmd + list(rule))
         logging.debug("ip6tables: applied %s" %rule)
+        return True
     except CalledProcessError:
-        logging.warning("ip6tables: failed to apply %s" %rule)
+        log_failure("ip6tables", rule)
+        return False
 
-def apply_rules(opt):
-    firewall_rules = get_config()
-    save_existing_rules(firewall_rules)
-    save_existing_rules_6(firewall_rules)
-        
-    for rule in firewall_rules["flush"]:
-        add_rule(rule)
-        
-    for rule in firewall_rules["flushv6"]:
-        add_rule_6(rule)
-        
-    logging.info("iptables: flushed existing rules")
+def optional_rule(rule):
+    #deleting what is not there or creating what already exists is not an error
+    table, cmd = split_table(rule)
+    return len(cmd) != 0 and cmd[0] in ("-D", "-N", "-X")
 
-    for rule in saved_rules:
-        add_rule(rule)
-        
-    for rule in saved_rules_6:
-        add_rule_6(rule)
-        
-    if opt == 1:
-        for rule in firewall_rules["defaults"]:
-            add_rule(rule)
-            
-        for rule in firewall_rules["defaultsv6"]:
-            add_rule_6(rule)
-        
-        for rule in firewall_rules["ipv4rules"]:
-            add_rule(rule)
+def log_failure(tool, rule):
+    if optional_rule(rule) is True:
+        logging.debug("%s: %s not applicable - skipped" %(tool, rule))
+    else:
+        logging.warning("%s: failed to apply %s" %(tool, rule))
+
+def add_rules(rules):
+    if backend == "nftables":
+        return nft.add_rules(rules, family="ipv4")
+    #one iptables-save and one iptables-restore instead of a check and a change per rule
+    live = read_ruleset()
+    if live is not None:
+        rules = pending_rules(live, rules)
+        if len(rules) == 0 or restore_rules(rules, noflush=True) is True:
+            return True
+    logging.debug("iptables: falling back to adding rules one by one")
+    failed = [rule for rule in rules if add_rule(rule) is False and optional_rule(rule) is False]
+    return len(failed) == 0
+
+def pending_rules(live, rules):
+    #drops what would fail in a --noflush batch: rules that already exist,
+    #deletes of rules that are gone and chains that are already there
+    model = copy_model(live)
+    pending = []
+    for rule in rules:
+        table, cmd = split_table(rule)
+        chains = model.get(table, new_table(table))["chains"]
+        if len(cmd) > 2 and cmd[0] in ("-A", "-D"):
+            present = rule_key(cmd[2:]) in (rule_key(r) for r in chains.get(cmd[1], []))
+            if present is (cmd[0] == "-A"):
+                continue
+        elif len(cmd) == 2 and cmd[0] == "-N" and cmd[1] in chains:
+            #declaring an existing chain in a restore file would flush it
+            continue
+        pending.append(rule)
+        simulate(model, [rule])
+    return pending
+
+def split_table(rule):
+    try:
+        i = rule.index("-t")
+        return rule[i+1], rule[:i] + rule[i+2:]
+    except (ValueError, IndexError):
+        return "filter", rule
+
+def quote_arg(arg):
+    if arg == "" or '"' in arg or any(c.isspace() for c in arg):
+        return '"%s"' %arg.replace('"', '\\"')
+    return arg
+
+def compile_restore(rules):
+    tables = {}
+    for rule in rules:
+        table, cmd = split_table(rule)
+        entry = tables.setdefault(table, {"chains" : {}, "lines" : []})
+        if len(cmd) == 0:
+            continue
+        elif cmd[0] == "-P" and len(cmd) == 3:
+            entry["chains"][cmd[1]] = cmd[2]
+        elif cmd[0] == "-N" and len(cmd) == 2:
+            entry["chains"].setdefault(cmd[1], "-")
+        elif cmd[0] in ("-F", "-X") and len(cmd) == 1:
+            #restoring a table flushes it and deletes its user-defined chains anyway
+            continue
+        else:
+            entry["lines"].append(" ".join(quote_arg(a) for a in cmd))
+    
+    payload = []
+    for table, entry in tables.items():
+        payload.append("*%s" %table)
+        for chain, policy in entry["chains"].items():
+            payload.append(":%s %s [0:0]" %(chain, policy))
+        payload.extend(entry["lines"])
+        payload.append("COMMIT")
+    return "\n".join(payload) + "\n"
+
+def restore_rules(rules, cmd=restore_cmd, noflush=False):
+    return restore_payload(compile_restore(rules), cmd=cmd, noflush=noflush)
+
+def restore_payload(payload, cmd=restore_cmd, noflush=False):
+    if noflush is True:
+        cmd = cmd + ["--noflush"]
+    try:
+        check_output(cmd, input=payload.encode("utf-8"), stderr=STDOUT)
+        logging.debug("%s: committed ruleset in one transaction" %cmd[0])
+        return True
+    except CalledProcessError as e:
+        logging.warning("%s: transaction rejected - %s" %(cmd[0], e.output.decode("utf-8").strip()))
+    except FileNotFoundError:
+        logging.warning("%s: command not found" %cmd[0])
+    return False
 
-        for rule in firewall_rules["ipv6rules"]:
-            add_rule_6(rule)
+def rule_key(rule):
+    #compares a rule spec with what iptables-save prints for it
+    return nft.spec_key(save_format(rule))
+
+def save_format(rule):
+    #iptables-save prints cgroup class ids in decimal and MARK targets as --set-xmark
+    rule = list(rule)
+    for i, arg in enumerate(rule[:-1]):
+        try:
+            if arg == "--cgroup":
+                rule[i+1] = str(int(rule[i+1], 0))
+            elif arg == "--set-mark":
+                value, mask = (rule[i+1].split("/") + ["0xffffffff"])[:2]
+                rule[i:i+2] = ["--set-xmark", "0x%x/0x%x" %(int(value, 0), int(mask, 0))]
+        except ValueError:
+            pass
+    return rule
+
+def new_table(table):
+    chains = {}
+    for chain in builtin_chains.get(table, []):
+        chains[chain] = []
+    return {"policies" : {}, "chains" : chains}
+
+def copy_model(model):
+    copy = {}
+    for table, entry in model.items():
+        copy[table] = {"policies" : dict(entry["policies"]),
+                       "chains" : {c : list(r) for c, r in entry["chains"].items()}
+                       }
+    return copy
+
+def parse_save(text):
+    model = {}
+    entry = None
+    for line in text.split("\n"):
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#") or line == "COMMIT":
+            continue
+        elif line.startswith("*"):
+            entry = model.setdefault(line[1:], new_table(line[1:]))
+        elif line.startswith(":") and entry is not None:
+            chain, policy = line[1:].split(" ")[:2]
+            entry["chains"].setdefault(chain, [])
+            if policy != "-":
+                entry["policies"][chain] = policy
+        elif entry is not None:
+            rule = shlex.split(line)
+            if len(rule) > 1 and rule[0] == "-A":
+                entry["chains"].setdefault(rule[1], []).append(tuple(rule[2:]))
+    return model
+
+def read_ruleset(cmd=save_cmd):
+    text = save_ruleset(cmd)
+    if text is not None:
+        return parse_save(text)
+    return None
+
+def save_ruleset(cmd=save_cmd):
+    try:
+        return check_output(cmd, stderr=STDOUT).decode("utf-8")
+    except (CalledProcessError, FileNotFoundError) as e:
+        logging.debug("%s: could not read live ruleset - %s" %(cmd[0], e))
+        return None
+
+def read_counters(table="mangle", cmd=save_cmd):
+    counters = {}
+    try:
+        saved = check_output(cmd + ["-c", "-t", table], stderr=STDOUT).decode("utf-8")
+    except (CalledProcessError, FileNotFoundError) as e:
+        logging.debug("%s: could not read counters - %s" %(cmd[0], e))
+        return counters
+    for line in saved.split("\n"):
+        if not line.startswith("["):
+            continue
+        count, rule = line.split(" ", 1)
+        rule = shlex.split(rule)
+        if "--comment" in rule:
+            packets, size = count.strip("[]").split(":")
+            counters[rule[rule.index("--comment")+1]] = (int(packets), int(size))
+    return counters
+
+def simulate(model, rules):
+    for rule in rules:
+        table, cmd = split_table(rule)
+        entry = model.setdefault(table, new_table(table))
+        chains = entry["chains"]
+        builtin = builtin_chains.get(table, [])
+        if len(cmd) == 0:
+            continue
+        elif cmd[0] == "-F":
+            for chain in chains.keys():
+                if len(cmd) == 1 or chain == cmd[1]:
+                    chains[chain] = []
+        elif cmd[0] == "-X":
+            for chain in list(chains.keys()):
+                if chain not in builtin and (len(cmd) == 1 or chain == cmd[1]):
+                    chains.pop(chain)
+        elif cmd[0] == "-P" and len(cmd) == 3:
+            entry["policies"][cmd[1]] = cmd[2]
+        elif cmd[0] == "-N" and len(cmd) == 2:
+            chains.setdefault(cmd[1], [])
+        elif cmd[0] == "-A" and len(cmd) > 2:
+            chains.setdefault(cmd[1], []).append(tuple(cmd[2:]))
+        elif cmd[0] == "-I" and len(cmd) > 2:
+            spec = list(cmd[2:])
+            pos = 0
+            if spec[0].isdigit():
+                pos = int(spec.pop(0)) - 1
+            chains.setdefault(cmd[1], []).insert(pos, tuple(spec))
+        elif cmd[0] == "-D" and len(cmd) > 2:
+            chain_rules = chains.get(cmd[1], [])
+            if len(cmd) == 3 and cmd[2].isdigit():
+                if int(cmd[2]) <= len(chain_rules):
+                    chain_rules.pop(int(cmd[2]) - 1)
+            else:
+                key = rule_key(cmd[2:])
+                for i, r in enumerate(chain_rules):
+                    if rule_key(r) == key:
+                        chain_rules.pop(i)
+                        break
+        else:
+            logging.debug("iptables: cannot model %s - ignored by reconciler" %rule)
+    return model
+
+def diff_chain(table, chain, live, desired):
+    want = Counter(rule_key(r) for r in desired)
+    keep = []
+    deletions = []
+    for i, rule in enumerate(live):
+        key = rule_key(rule)
+        if want[key] > 0:
+            want[key] -= 1
+            keep.append(key)
+        else:
+            deletions.append(i + 1)
+    
+    changes = [["-t", table, "-D", chain, str(n)] for n in reversed(deletions)]
+    j = 0
+    for i, rule in enumerate(desired):
+        if j < len(keep) and keep[j] == rule_key(rule):
+            j += 1
+        else:
+            changes.append(["-t", table, "-I", chain, str(i + 1)] + list(rule))
+    
+    if j < len(keep):
+        #remaining rules are in the wrong order - rewrite the whole chain
+        changes = [["-t", table, "-F", chain]]
+        changes.extend(["-t", table, "-A", chain] + list(r) for r in desired)
+    return changes
+
+def unique_rules(rules):
+    #a rule listed twice in a profile or appended twice at runtime is only kept once
+    seen = set()
+    unique = []
+    for rule in rules:
+        key = rule_key(rule)
+        if key not in seen:
+            seen.add(key)
+            unique.append(rule)
+    return unique
+
+def reconcile(live, rules):
+    desired = simulate(copy_model(live), rules)
+    changes = []
+    removed_chains = []
+    for table, entry in desired.items():
+        live_entry = live.get(table, new_table(table))
+        builtin = builtin_chains.get(table, [])
+        for chain, policy in entry["policies"].items():
+            if live_entry["policies"].get(chain) != policy:
+                changes.append(["-t", table, "-P", chain, policy])
+        for chain in entry["chains"].keys():
+            if chain not in live_entry["chains"] and chain not in builtin:
+                changes.append(["-t", table, "-N", chain])
+        for chain in live_entry["chains"].keys():
+            if chain not in entry["chains"]:
+                removed_chains.append(["-t", table, "-X", chain])
+        chains = list(entry["chains"].keys())
+        chains.extend(c for c in live_entry["chains"].keys() if c not in entry["chains"])
+        for chain in chains:
+            changes.extend(diff_chain(table, chain,
+                                      live_entry["chains"].get(chain, []),
+                                      unique_rules(entry["chains"].get(chain, []))
+                                      ))
+    return changes + removed_chains
+
+def compile_state(rules):
+    #turns the rules of one firewall state into restore lines for the chains qomui owns -
+    #jumps from the builtin chains and QOMUI-ALLOW depend on the live ruleset and are
+    #left to state_payload; None if the state touches anything else
+    owned = list(qomui_chains.values()) + [allow_chain]
+    state = {"decls" : [], "lines" : [], "jump" : False, "allow" : False, "remove" : False}
+    appended = set()
+    for rule in rules:
+        table, cmd = split_table(rule)
+        if table != "filter" or len(cmd) < 2:
+            return None
+        op, chain, spec = cmd[0], cmd[1], list(cmd[2:])
+        if op == "-P" and len(spec) == 1:
+            state["decls"].append(":%s %s [0:0]" %(chain, spec[0]))
+        elif op in ("-D", "-A") and chain in qomui_chains and spec == ["-j", qomui_chains[chain]]:
+            state["jump"] = state["jump"] or op == "-A"
+        elif op == "-N" and len(spec) == 0 and chain in qomui_chains.values():
+            #declaring a chain in a --noflush restore creates or flushes it
+            decl = ":%s - [0:0]" %chain
+            if decl not in state["decls"]:
+                state["decls"].append(decl)
+        elif op == "-N" and len(spec) == 0 and chain == allow_chain:
+            state["allow"] = True
+        elif op in ("-F", "-X") and len(spec) == 0 and chain in owned:
+            state["remove"] = state["remove"] or op == "-X"
+        elif op in ("-A", "-I") and chain in qomui_chains.values():
+            line = " ".join(quote_arg(a) for a in cmd)
+            #same guard as unique_rules - an appended duplicate is dropped
+            if op == "-I" or line not in appended:
+                appended.add(line)
+                state["lines"].append(line)
+        else:
+            return None
+    return state
+
+def precompile(config):
+    #every state apply_rules can ask for, built once per firewall.json
+    states = {}
+    for family, v6, server_set in (("ipv4", False, server_sets["inet"]), ("ipv6", True, server_sets["inet6"])):
+        for opt in (1, 0, None):
+            for ping in (0, 1):
+                for listed in (None, server_set):
+                    rules = chain_rules(config, opt, v6=v6, server_set=listed, ping=ping)
+                    states[(family, opt, ping, listed)] = compile_state(rules)
+    return states
+
+def precompiled(config):
+    for signature, cached, states in config_cache.values():
+        if cached is config:
+            return states
+    return {}
+
+def state_payload(state, live):
+    #only the builtin jumps and the chains qomui owns are checked - other rules do not matter
+    chains = live.get("filter", new_table("filter"))["chains"]
+    decls = list(state["decls"])
+    lines = []
+    appends = []
+    for chain, qomui_chain in qomui_chains.items():
+        jumps = [r for r in chains.get(chain, []) if tuple(r) == ("-j", qomui_chain)]
+        if state["jump"] is True and len(jumps) == 1:
+            continue
+        lines.extend("-D %s -j %s" %(chain, qomui_chain) for j in jumps)
+        if state["jump"] is True:
+            appends.append("-A %s -j %s" %(chain, qomui_chain))
+    if state["allow"] is True and allow_chain not in chains:
+        decls.append(":%s - [0:0]" %allow_chain)
+    if state["remove"] is True:
+        present = [c for c in list(qomui_chains.values()) + [allow_chain] if c in chains]
+        lines.extend("-F %s" %c for c in present)
+        lines.extend("-X %s" %c for c in present)
+    lines.extend(state["lines"])
+    lines.extend(appends)
+    return "\n".join(["*filter"] + decls + lines + ["COMMIT"]) + "\n"
+
+def commit_rules(rules, live, cmd=restore_cmd, fallback=ipt_rule, timing=None, entry=None):
+    if timing is None:
+        timing = {}
+    if entry is None:
+        entry = {}
+    t0 = time.time()
+    if live is not None:
+        changes = reconcile(live, rules)
+        payload = compile_restore(changes) if len(changes) != 0 else ""
+        entry["method"] = "reconcile"
+        timing["reconcile"] = (time.time() - t0) * 1000
+        t0 = time.time()
             
-        logging.info("iptables: activated firewall")
-        
+        if payload == "":
+            logging.debug("%s: live ruleset already up to date" %cmd[0])
+            timing["restore"] = 0.0
+            entry["changes"] = "0"
+            return True
+        elif restore_payload(payload, cmd=cmd, noflush=True) is True:
+            timing["restore"] = (time.time() - t0) * 1000
+            entry["changes"] = str(len([l for l in payload.split("\n") if l.startswith("-")]))
+            return True
+        rules = reconcile(live, rules)
+    logging.info("%s: falling back to applying rules one by one" %cmd[0])
+    entry["method"] = "fallback"
+    entry["changes"] = str(len(rules))
+    failed = [rule for rule in rules if fallback(rule) is False and optional_rule(rule) is False]
+    timing["fallback"] = (time.time() - t0) * 1000
+    return len(failed) == 0
+
+def apply_state(state, cmds, timing, entry):
+    save, restore, fallback = cmds
+    t0 = time.time()
+    saved = save_ruleset(save + ["-t", "filter"])
+    timing["save"] = (time.time() - t0) * 1000
+    if saved is None:
+        return False
+    payload = state_payload(state, parse_save(saved))
+    t0 = time.time()
+    #a rejected transaction changes nothing - the caller falls back to reconciling
+    if restore_payload(payload, cmd=restore, noflush=True) is False:
+        return False
+    timing["restore"] = (time.time() - t0) * 1000
+    entry["method"] = "precompiled"
+    entry["changes"] = str(len([l for l in payload.split("\n") if l.startswith("-")]))
+    return True
+
+def apply_family(family, rules, cmds, timing, opt=None, legacy=None, result=None, state=None):
+    save, restore, fallback = cmds
+    entry = {"time" : time.strftime("%Y-%m-%d %H:%M:%S"), "family" : family,
+             "state" : str(opt), "status" : "committed"}
+    t0 = time.time()
+    if state is not None and legacy is None and apply_state(state, cmds, timing, entry) is True:
+        timing["total"] = (time.time() - t0) * 1000
+        entry["duration"] = "%.1f" %timing["total"]
+        with journal_lock:
+            journal.append(entry)
+        if result is not None:
+            result[family] = entry["status"]
+        return
+    saved = save_ruleset(save)
+    live = parse_save(saved) if saved is not None else None
+    timing["save"] = (time.time() - t0) * 1000
+    if legacy is not None and live is not None:
+        rules = legacy_rules(live, legacy) + list(rules)
+    try:
+        success = commit_rules(rules, live, cmd=restore, fallback=fallback, timing=timing, entry=entry)
+    except Exception as e:
+        logging.error("%s: transaction aborted - %s" %(restore[0], e))
+        success = False
+
+    if success is False and saved is None:
+        logging.warning("%s: some rules could not be applied - no snapshot to roll back to" %restore[0])
+        entry["status"] = "incomplete"
+    elif success is False:
+        entry["status"] = rollback(saved, restore, timing)
+    timing["total"] = (time.time() - t0) * 1000
+    entry["duration"] = "%.1f" %timing["total"]
+    with journal_lock:
+        journal.append(entry)
+    if result is not None:
+        result[family] = entry["status"]
+
+def rollback(saved, cmd=restore_cmd, timing=None):
+    t0 = time.time()
+    #a full restore replaces every table contained in the snapshot
+    result = restore_payload(saved, cmd=cmd)
+    if timing is not None:
+        timing["rollback"] = (time.time() - t0) * 1000
+    if result is True:
+        logging.warning("%s: rolled back to previous ruleset" %cmd[0])
+        return "rolled back"
+    logging.error("%s: rollback failed - ruleset may be incomplete" %cmd[0])
+    return "failed"
+
+def get_journal():
+    with journal_lock:
+        return [dict(entry) for entry in journal]
+
+def delete_rule(rule):
+    table, cmd = split_table(rule)
+    spec = cmd[2:]
+    if cmd[0] == "-I" and len(spec) > 0 and spec[0].isdigit():
+        spec = spec[1:]
+    return ["-t", table, "-D", cmd[1]] + list(spec)
+
+def legacy_rules(live, profile):
+    #versions before the QOMUI chains appended the whole profile to the builtin chains -
+    #only remove it where all of it is still there, so rules of other programs stay
+    chains = live.get("filter", new_table("filter"))["chains"]
+    by_chain = {}
+    for rule in profile:
+        table, cmd = split_table(rule)
+        if table == "filter" and len(cmd) > 2 and cmd[0] in ("-A", "-I") and cmd[1] in qomui_chains:
+            by_chain.setdefault(cmd[1], []).append(delete_rule(rule))
+    deletions = []
+    for chain, chain_deletions in by_chain.items():
+        present = Counter(rule_key(r) for r in chains.get(chain, []))
+        wanted = Counter(rule_key(d[4:]) for d in chain_deletions)
+        if all(present[key] >= count for key, count in wanted.items()):
+            deletions.extend(chain_deletions)
+    return deletions
+
+def rename_chain(rule, chains):
+    table, cmd = split_table(rule)
+    if table == "filter" and len(cmd) > 1 and cmd[1] in chains:
+        return [cmd[0], chains[cmd[1]]] + list(cmd[2:])
+    return list(rule)
+
+def chain_rules(firewall_rules, opt, v6=False, server_set=None, ping=0):
+    if v6 is True:
+        profile = firewall_rules["ipv6rules"]
+        defaults = firewall_rules["defaultsv6"]
+        unsecure = firewall_rules["unsecurev6"]
+    else:
+        profile = firewall_rules["ipv4rules"]
+        defaults = firewall_rules["defaults"]
+        unsecure = firewall_rules["unsecure"]
+
+    rules = []
+    for chain, qomui_chain in qomui_chains.items():
+        rules.append(["-D", chain, "-j", qomui_chain])
+
+    if opt is None:
+        for chain in list(qomui_chains.values()) + [allow_chain]:
+            rules.extend([["-F", chain], ["-X", chain]])
+        rules.extend(unsecure)
+        return rules
+
+    for chain in qomui_chains.values():
+        rules.extend([["-N", chain], ["-F", chain]])
+    rules.append(["-N", allow_chain])
+    rules.append(["-A", qomui_chains["INPUT"], "-j", allow_chain])
+    rules.append(["-A", qomui_chains["OUTPUT"], "-j", allow_chain])
+    if server_set is not None:
+        rules.append(["-A", qomui_chains["OUTPUT"], "-m", "set", "--match-set", 
+                      server_set, "dst", "-j", "ACCEPT"])
+    rules.extend(rename_chain(rule, qomui_chains) for rule in profile)
+    if ping == 1 and v6 is False:
+        rules.extend(rename_chain(rule, qomui_chains) for rule in firewall_rules["allowping"])
+
+    if opt == 1:
+        for chain, qomui_chain in qomui_chains.items():
+            rules.append(["-A", chain, "-j", qomui_chain])
+        rules.extend(defaults)
     elif opt == 0:
-        for rule in firewall_rules["unsecure"]:
-            add_rule(rule)
-            
-        for rule in firewall_rules["unsecurev6"]:
-            add_rule_6(rule)
+        rules.extend(unsecure)
+    return rules
+
+def apply_rules(opt, ping=0):
+    global backend
+    firewall_rules = get_config()
+    try:
+        active = firewall_rules["backend"]
+    except KeyError:
+        active = "iptables"
+    chain_opt = opt
+    new_timings = {}
+    
+    if active == "nftables":
+        if opt == 1:
+            profile = firewall_rules["defaults"] + firewall_rules["ipv4rules"]
+            profile_6 = firewall_rules["defaultsv6"] + firewall_rules["ipv6rules"]
+        else:
+            profile = firewall_rules["unsecure"]
+            profile_6 = firewall_rules["unsecurev6"]
+        if ping == 1:
+            profile = profile + firewall_rules["allowping"]
+        t0 = time.time()
+        nft_success = nft.apply_ruleset(profile, profile_6)
+        new_timings["nftables"] = {"total" : (time.time() - t0) * 1000}
+        if nft_success is True:
+            #kill switch lives in the nft table - release the iptables chains
+            chain_opt = None
+        else:
+            logging.warning("nft: falling back to iptables backend")
+            active = "iptables"
+    #set once before the family threads start - they only use iptables directly
+    backend = active
             
-        logging.info("iptables: deactivated firewall")
+    server_set = None
+    server_set_6 = None
+    if active == "iptables":
+        nft.delete_table()
+        if create_server_sets() is True:
+            server_set = server_sets["inet"]
+            server_set_6 = server_sets["inet6"]
+        
+    #iptables and ip6tables use separate tables and locks
+    families = {"ipv4" : (chain_rules(firewall_rules, chain_opt, server_set=server_set, ping=ping),
+                          (save_cmd, restore_cmd, ipt_rule)),
+                "ipv6" : (chain_rules(firewall_rules, chain_opt, v6=True, server_set=server_set_6),
+                          (save6_cmd, restore6_cmd, ipt_rule_6))
+                }
+    states = precompiled(firewall_rules)
+    keys = {"ipv4" : ("ipv4", chain_opt, ping, server_set), "ipv6" : ("ipv6", chain_opt, 0, server_set_6)}
+    #the cleanup of pre-QOMUI-chain rules runs until it succeeded once
+    legacy = {"ipv4" : None, "ipv6" : None}
+    if not os.path.exists(legacy_marker):
+        legacy = {"ipv4" : firewall_rules["ipv4rules"], "ipv6" : firewall_rules["ipv6rules"]}
+    results = {}
+    threads = []
+    for family, (rules, cmds) in families.items():
+        new_timings[family] = {}
+        thread = threading.Thread(target=apply_family, args=(family, rules, cmds, 
+                                                             new_timings[family], opt,
+                                                             legacy[family], results,
+                                                             states.get(keys[family])))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if legacy["ipv4"] is not None and set(results.values()) == {"committed"}:
+        try:
+            open(legacy_marker, "w").close()
+        except OSError as e:
+            logging.debug("Could not write %s: %s" %(legacy_marker, e))
         
-def save_existing_rules(firewall_rules):
-    existing_rules = check_output(["iptables", "-S"]).decode("utf-8")
-    for line in existing_rules.split('\n'):
-        rpl = line.replace("/32", "")
-        rule = shlex.split(rpl)
-        if len(rule) != 0:
-            match = 0
-            omit = firewall_rules["ipv4rules"] + firewall_rules["flush"]
-            for x in omit:
-                if Counter(x) == Counter(rule):
-                    match = 1
-            if match == 0 and rule not in saved_rules:
-                saved_rules.append(rule)
-            match = 0
+    timings.clear()
+    timings.update(new_timings)
+    for family, timing in sorted(timings.items()):
+        phases = ", ".join("%s %.1f ms" %(k, v) for k, v in sorted(timing.items()) if k != "total")
+        logging.info("Firewall %s applied in %.1f ms (%s)" %(family, timing.get("total", 0), phases))
             
-def save_existing_rules_6(firewall_rules):
-    existing_rules = check_output(["ip6tables", "-S"]).decode("utf-8")
-    for line in existing_rules.split('\n'):
-        rpl = line.replace("/32", "")
-        rule = shlex.split(rpl)
-        if len(rule) != 0:
-            match = 0
-            omit = firewall_rules["ipv6rules"] + firewall_rules["flushv6"]
-            for x in omit:
-                if Counter(x) == Counter(rule):
-                    match = 1
-            if match == 0 and rule not in saved_rules_6:
-                saved_rules_6.append(rule)
-            match = 0
-
-def allow_ping(opt):
     if opt == 1:
-        firewall_rules = get_config()
-        for rule in firewall_rules["allowping"]:
-                add_rule(rule)
+        logging.info("iptables: activated firewall")
+    elif opt == 0:
+        logging.info("iptables: deactivated firewall")
+    if ping == 1:
         logging.info("iptables: Ping allowed")
-            
-def get_config():
+
+def allow_ip(ip):
+    if ip in listed_servers:
+        logging.debug("iptables: %s already allowed via server set" %ip)
+    else:
+        add_rule(["-A", allow_chain, "-d", ip, "-j", "ACCEPT"])
+
+def block_ip(ip):
+    if ip not in listed_servers:
+        add_rule(["-D", allow_chain, "-d", ip, "-j", "ACCEPT"])
+
+def run_ipset(payload):
     try:
-        with open ("%s/firewall.json" %(rootdir), "r") as f:
-                return json.load(f)
-    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
-        logging.debug("Loading default firewall configuration")
+        check_output(ipset_cmd + ["restore"], input=payload.encode("utf-8"), stderr=STDOUT)
+        return True
+    except CalledProcessError as e:
+        logging.warning("ipset: %s" %e.output.decode("utf-8").strip())
+    except FileNotFoundError:
+        logging.debug("ipset: command not found - server allowlist disabled")
+    return False
+
+def create_server_sets():
+    payload = ""
+    for family, name in server_sets.items():
+        payload += "create %s hash:ip family %s -exist\n" %(name, family)
+    return run_ipset(payload)
+
+def set_servers(ips):
+    global listed_servers
+    #server.json keeps the hostname when it could not be resolved
+    valid = set()
+    for ip in set(ips):
+        if ip in ("", "0.0.0.0"):
+            continue
         try:
-            with open ("%s/firewall_default.json" %(rootdir), "r") as f:
-                    return json.load(f)
-        except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
-                logging.debug("Failed to load firewall configuration")
-                return None
-        
+            valid.add(ipaddress.ip_address(ip))
+        except ValueError:
+            logging.warning("iptables: %s is not an ip address - not added to server set" %ip)
+    ips = set(str(ip) for ip in valid)
+    v4 = sorted(str(ip) for ip in valid if ip.version == 4)
+    v6 = sorted(str(ip) for ip in valid if ip.version == 6)
+    
+    if backend == "nftables":
+        success = nft.set_servers(v4, v6)
+    else:
+        payload = ""
+        for family, name, members in (("inet", server_sets["inet"], v4), 
+                                      ("inet6", server_sets["inet6"], v6)):
+            #fill a temporary set and swap it in so the allowlist is never empty
+            payload += "create %s hash:ip family %s -exist\n" %(name, family)
+            payload += "create %s_tmp hash:ip family %s -exist\n" %(name, family)
+            payload += "flush %s_tmp\n" %name
+            payload += "".join("add %s_tmp %s -exist\n" %(name, ip) for ip in members)
+            payload += "swap %s_tmp %s\n" %(name, name)
+            payload += "destroy %s_tmp\n" %name
+        success = run_ipset(payload)
         
+    if success is True:
+        listed_servers = ips
+        logging.info("iptables: allowed %s VPN servers via server set" %len(ips))
+    return success
+
+def get_config():
+    config = load_config("%s/firewall.json" %(rootdir))
+    if config is None:
+        logging.debug("Loading default firewall configuration")
+        config = load_config("%s/firewall_default.json" %(rootdir))
+        if config is None:
+            logging.debug("Failed to load firewall configuration")
+    return config
 
+def load_config(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
     
+    #a new firewall.json installed by mv_config changes mtime/size
+    signature = (stat.st_mtime_ns, stat.st_size)
+    try:
+        cached_signature, config, states = config_cache[path]
+        if cached_signature == signature:
+            return config
+    except KeyError:
+        pass
+    
+    states = {}
+    try:
+        with open (path, "r") as f:
+            config = validate_config(json.load(f))
+        states = precompile(config)
+        logging.debug("Loaded firewall configuration from %s" %path)
+    except (json.decoder.JSONDecodeError, ValueError, TypeError) as e:
+        logging.error("Invalid firewall configuration %s: %s" %(path, e))
+        config = None
+    except (FileNotFoundError, PermissionError) as e:
+        logging.debug("Could not read %s: %s" %(path, e))
+        return None
+    config_cache[path] = (signature, config, states)
+    return config
 
+def validate_config(raw):
+    config = {}
+    for key, value in raw.items():
+        if key == "backend":
+            if value not in ("iptables", "nftables"):
+                raise ValueError("unknown backend %s" %value)
+            config[key] = value
+        elif isinstance(value, list):
+            rules = []
+            for rule in value:
+                if not isinstance(rule, list) or not all(isinstance(a, str) for a in rule):
+                    raise ValueError("%s: malformed rule %s" %(key, rule))
+                if len(rule) != 0:
+                    rules.append(tuple(rule))
+            config[key] = tuple(rules)
+        else:
+            config[key] = value
+            
+    for key in rule_lists:
+        if key not in config:
+            raise ValueError("missing rule list %s" %key)
+    return config
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import math
+import logging
+
+zone_tab = "/usr/share/zoneinfo/zone.tab"
+earth_radius = 6371.0
+
+#approximate coordinates (lat, lon) - capitals or main server locations
+countries = {
+    "albania" : (41.33, 19.82), "argentina" : (-34.60, -58.38), "australia" : (-33.87, 151.21),
+    "austria" : (48.21, 16.37), "belgium" : (50.85, 4.35), "brazil" : (-23.55, -46.63),
+    "bulgaria" : (42.70, 23.32), "canada" : (43.65, -79.38), "chile" : (-33.45, -70.67),
+    "china" : (39.90, 116.40), "colombia" : (4.71, -74.07), "costa rica" : (9.93, -84.08),
+    "croatia" : (45.81, 15.98), "cyprus" : (35.17, 33.36), "czechia" : (50.08, 14.44),
+    "czech republic" : (50.08, 14.44), "denmark" : (55.68, 12.57), "estonia" : (59.44, 24.75),
+    "finland" : (60.17, 24.94), "france" : (48.86, 2.35), "germany" : (50.11, 8.68),
+    "greece" : (37.98, 23.73), "hong kong" : (22.32, 114.17), "hungary" : (47.50, 19.04),
+    "iceland" : (64.15, -21.94), "india" : (19.08, 72.88), "indonesia" : (-6.21, 106.85),
+    "ireland" : (53.35, -6.26), "israel" : (32.09, 34.78), "italy" : (45.46, 9.19),
+    "japan" : (35.68, 139.69), "latvia" : (56.95, 24.11), "lithuania" : (54.69, 25.28),
+    "luxembourg" : (49.61, 6.13), "malaysia" : (3.14, 101.69), "mexico" : (19.43, -99.13),
+    "moldova" : (47.01, 28.86), "moldova, republic of" : (47.01, 28.86),
+    "netherlands" : (52.37, 4.90), "new zealand" : (-36.85, 174.76), "norway" : (59.91, 10.75),
+    "poland" : (52.23, 21.01), "portugal" : (38.72, -9.14), "romania" : (44.43, 26.10),
+    "russia" : (55.76, 37.62), "russian federation" : (55.76, 37.62), "serbia" : (44.79, 20.45),
+    "singapore" : (1.35, 103.82), "slovakia" : (48.15, 17.11), "slovenia" : (46.06, 14.51),
+    "south africa" : (-26.20, 28.05), "south korea" : (37.57, 126.98),
+    "korea, republic of" : (37.57, 126.98), "spain" : (40.42, -3.70), "sweden" : (59.33, 18.07),
+    "switzerland" : (47.38, 8.54), "taiwan" : (25.03, 121.57),
+    "taiwan, province of china" : (25.03, 121.57), "thailand" : (13.76, 100.50),
+    "turkey" : (41.01, 28.98), "ukraine" : (50.45, 30.52), "united arab emirates" : (25.20, 55.27),
+    "united kingdom" : (51.51, -0.13), "united states" : (39.83, -98.58),
+    "vietnam" : (21.03, 105.85), "viet nam" : (21.03, 105.85)
+    }
+
+cities = {
+    "amsterdam" : (52.37, 4.90), "athens" : (37.98, 23.73), "atlanta" : (33.75, -84.39),
+    "auckland" : (-36.85, 174.76), "barcelona" : (41.39, 2.17), "belgrade" : (44.79, 20.45),
+    "berlin" : (52.52, 13.40), "bern" : (46.95, 7.45), "boston" : (42.36, -71.06),
+    "bratislava" : (48.15, 17.11), "brisbane" : (-27.47, 153.03), "brussels" : (50.85, 4.35),
+    "bucharest" : (44.43, 26.10), "budapest" : (47.50, 19.04), "buffalo" : (42.89, -78.88),
+    "calgary" : (51.05, -114.07), "charlotte" : (35.23, -80.84), "chicago" : (41.88, -87.63),
+    "chisinau" : (47.01, 28.86), "copenhagen" : (55.68, 12.57), "dallas" : (32.78, -96.80),
+    "denver" : (39.74, -104.99), "dublin" : (53.35, -6.26), "dusseldorf" : (51.23, 6.77),
+    "düsseldorf" : (51.23, 6.77), "frankfurt" : (50.11, 8.68), "frankfurt am main" : (50.11, 8.68),
+    "fremont" : (37.55, -121.99), "gothenburg" : (57.71, 11.97), "hamburg" : (53.55, 9.99),
+    "helsinki" : (60.17, 24.94), "hong kong" : (22.32, 114.17), "houston" : (29.76, -95.37),
+    "istanbul" : (41.01, 28.98), "jacksonville" : (30.33, -81.66), "johannesburg" : (-26.20, 28.05),
+    "kiev" : (50.45, 30.52), "kyiv" : (50.45, 30.52), "las vegas" : (36.17, -115.14),
+    "lisbon" : (38.72, -9.14), "ljubljana" : (46.06, 14.51), "london" : (51.51, -0.13),
+    "los angeles" : (34.05, -118.24), "luxembourg" : (49.61, 6.13), "madrid" : (40.42, -3.70),
+    "malmo" : (55.60, 13.00), "malmö" : (55.60, 13.00), "manchester" : (53.48, -2.24),
+    "melbourne" : (-37.81, 144.96), "miami" : (25.76, -80.19), "milan" : (45.46, 9.19),
+    "montreal" : (45.50, -73.57), "moscow" : (55.76, 37.62), "new york" : (40.71, -74.01),
+    "new york city" : (40.71, -74.01), "newark" : (40.74, -74.17), "oslo" : (59.91, 10.75),
+    "paris" : (48.86, 2.35), "perth" : (-31.95, 115.86), "phoenix" : (33.45, -112.07),
+    "prague" : (50.08, 14.44), "raleigh" : (35.78, -78.64), "reykjavik" : (64.15, -21.94),
+    "riga" : (56.95, 24.11), "rome" : (41.90, 12.50), "salt lake city" : (40.76, -111.89),
+    "san francisco" : (37.77, -122.42), "san jose" : (37.34, -121.89), "sao paulo" : (-23.55, -46.63),
+    "são paulo" : (-23.55, -46.63), "seattle" : (47.61, -122.33), "secaucus" : (40.79, -74.06),
+    "seoul" : (37.57, 126.98), "silicon valley" : (37.39, -122.08), "singapore" : (1.35, 103.82),
+    "sofia" : (42.70, 23.32), "stockholm" : (59.33, 18.07), "sydney" : (-33.87, 151.21),
+    "taipei" : (25.03, 121.57), "tallinn" : (59.44, 24.75), "tel aviv" : (32.09, 34.78),
+    "tokyo" : (35.68, 139.69), "toronto" : (43.65, -79.38), "uppsala" : (59.86, 17.64),
+    "vancouver" : (49.28, -123.12), "vienna" : (48.21, 16.37), "vilnius" : (54.69, 25.28),
+    "warsaw" : (52.23, 21.01), "washington" : (38.91, -77.04), "washington dc" : (38.91, -77.04),
+    "zagreb" : (45.81, 15.98), "zurich" : (47.38, 8.54), "zürich" : (47.38, 8.54)
+    }
+
+def distance(a, b):
+    #great-circle distance in km (haversine)
+    lat1, lon1, lat2, lon2 = [math.radians(x) for x in (a[0], a[1], b[0], b[1])]
+    h = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * earth_radius * math.asin(min(1, math.sqrt(h)))
+
+def server_coords(val):
+    city = val.get("city", "").strip().lower()
+    if city in cities:
+        return cities[city]
+    return countries.get(val.get("country", "").strip().lower())
+
+def parse_iso6709(coords):
+    #zone.tab format: +DDMM+DDDMM or +DDMMSS+DDDMMSS
+    match = re.match(r"([+-]\d+)([+-]\d+)$", coords)
+    if match is None:
+        return None
+    result = []
+    for part, degrees in ((match.group(1), 2), (match.group(2), 3)):
+        sign = -1 if part[0] == "-" else 1
+        digits = part[1:]
+        value = int(digits[:degrees]) + int(digits[degrees:degrees+2]) / 60.0
+        if len(digits) > degrees + 2:
+            value += int(digits[degrees+2:]) / 3600.0
+        result.append(sign * value)
+    return tuple(result)
+
+def timezone_coords():
+    try:
+        zone = os.path.realpath("/etc/localtime").split("zoneinfo/")[1]
+    except IndexError:
+        return None
+    try:
+        with open(zone_tab, "r") as f:
+            for line in f:
+                fields = line.split("\t")
+                if len(fields) >= 3 and fields[2].strip() == zone:
+                    return parse_iso6709(fields[1])
+    except FileNotFoundError:
+        pass
+    return None
+
+def locate(location=""):
+    #configured "lat,lon" or city/country name, otherwise the system timezone
+    if location:
+        try:
+            lat, lon = [float(x) for x in location.split(",")]
+            return (lat, lon)
+        except ValueError:
+            coords = cities.get(location.strip().lower(), countries.get(location.strip().lower()))
+            if coords is not None:
+                return coords
+            logging.debug("Geo: unknown location %s" %location)
+    return timezone_coords()
+
+def distances(server_dict, origin):
+    result = {}
+    if origin is None:
+        return result
+    for k, v in server_dict.items():
+        coords = server_coords(v)
+        if coords is not None:
+            result[k] = round(distance(origin, coords))
+    return result
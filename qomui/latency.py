@@ -2,49 +2,21 @@
 # -*- coding: utf-8 -*-
 
 from PyQt5 import QtCore
-from subprocess import CalledProcessError, check_output
-import re
-import logging
+from qomui import probe
 
 
 class LatencyCheck(QtCore.QThread):
+    #runs a probe.Sweep off the gui thread and hands its results over as signals
     lat_signal = QtCore.pyqtSignal(tuple)
     finished = QtCore.pyqtSignal()
 
-    def __init__(self, server_dict, interface):
+    def __init__(self, server_dict, interface, **kwargs):
         QtCore.QThread.__init__(self)
-        self.server_dict = server_dict
-        self.interface = interface
-            
+        self.sweep = probe.Sweep(server_dict, interface, **kwargs)
+
+    def stop(self):
+        self.sweep.stop()
+
     def run(self):
-        try:
-            for k,v in self.server_dict.items():
-                try:
-                    ip = v["ip"]
-                except KeyError:
-                    ip = v["prim_ip"]
-                
-                try:
-                    pinger = check_output(["ping", "-c", "1", "-W", "1", "-I", "%s" %self.interface, "%s" %ip]).decode("utf-8")
-                    latencysearch = re.search(r'rtt min/avg/max/mdev = \d+(?:\.\d+)?/\d+(?:\.\d+)?/\d+(?:\.\d+)?/\d+(?:\.\d+)?', pinger)
-                    if latencysearch != None:
-                        latencyraw = str(latencysearch.group())
-                        latency = latencyraw.split("/")[4]
-                    else:
-                        latency = "999"
-                except CalledProcessError:
-                    latency = "999"
-                
-                latency_float = float(latency)
-                if latency != "999":
-                    latency_string = "{0:.1f} ms".format(latency_float)
-                else:
-                    latency_string = "N.A."
-                
-                self.lat_signal.emit((k, latency_string, latency_float))
-                
-        except RuntimeError:
-            logging.debug("RuntimeError: Latency check is already running")
-            
+        self.sweep.run(self.lat_signal.emit)
         self.finished.emit()
-                
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import socket
+import struct
+import logging
+
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_REPLACE = 0x100
+
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+FRA_FWMARK = 10
+FRA_TABLE = 15
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+FR_ACT_TO_TBL = 1
+
+timeout = 5
+nlmsghdr = struct.Struct("=IHHII")
+rtmsg = struct.Struct("=BBBBBBBBI")
+rtattr = struct.Struct("=HH")
+
+def align(length):
+    return (length + 3) & ~3
+
+def attr(attr_type, data):
+    length = rtattr.size + len(data)
+    return rtattr.pack(length, attr_type) + data + b"\0" * (align(length) - length)
+
+def parse_attrs(data):
+    attrs = {}
+    offset = 0
+    while offset + rtattr.size <= len(data):
+        length, attr_type = rtattr.unpack_from(data, offset)
+        if length < rtattr.size:
+            break
+        attrs[attr_type] = data[offset+rtattr.size:offset+length]
+        offset += align(length)
+    return attrs
+
+def parse_messages(data):
+    offset = 0
+    while offset + nlmsghdr.size <= len(data):
+        length, msg_type, flags, seq, pid = nlmsghdr.unpack_from(data, offset)
+        if length < nlmsghdr.size:
+            break
+        yield msg_type, seq, data[offset+nlmsghdr.size:offset+length]
+        offset += align(length)
+
+def open_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.bind((0, 0))
+    #a lost ack must not block the service forever
+    sock.settimeout(timeout)
+    return sock
+
+def parse_prefix(dst):
+    if dst == "default":
+        dst = "0.0.0.0/0"
+    if "/" in dst:
+        addr, prefix = dst.split("/")
+        return addr, int(prefix)
+    return dst, 32
+
+def route_msg(cmd, dst, gateway=None, dev=None, table=RT_TABLE_MAIN):
+    addr, prefix = parse_prefix(dst)
+    scope = RT_SCOPE_UNIVERSE if gateway is not None else RT_SCOPE_LINK
+    if cmd != "add":
+        #the kernel matches deletes on scope unless it is RT_SCOPE_NOWHERE
+        scope = RT_SCOPE_NOWHERE
+    body = rtmsg.pack(socket.AF_INET, prefix, 0, 0, table if table < 256 else 0,
+                      RTPROT_BOOT, scope, RTN_UNICAST, 0)
+    body += attr(RTA_TABLE, struct.pack("=I", table))
+    if prefix != 0:
+        body += attr(RTA_DST, socket.inet_pton(socket.AF_INET, addr))
+    if gateway is not None:
+        body += attr(RTA_GATEWAY, socket.inet_pton(socket.AF_INET, gateway))
+    if dev is not None:
+        body += attr(RTA_OIF, struct.pack("=I", socket.if_nametoindex(dev)))
+    if cmd == "add":
+        return RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE, body
+    return RTM_DELROUTE, 0, body
+
+def rule_msg(cmd, fwmark, table):
+    body = rtmsg.pack(socket.AF_INET, 0, 0, 0, table if table < 256 else 0,
+                      0, 0, FR_ACT_TO_TBL, 0)
+    body += attr(FRA_FWMARK, struct.pack("=I", fwmark))
+    body += attr(FRA_TABLE, struct.pack("=I", table))
+    if cmd == "add":
+        return RTM_NEWRULE, NLM_F_CREATE | NLM_F_EXCL, body
+    return RTM_DELRULE, 0, body
+
+def transact(messages, ignore=()):
+    if len(messages) == 0:
+        return
+    sock = open_socket()
+    try:
+        payload = b""
+        for seq, (msg_type, flags, body) in enumerate(messages, 1):
+            payload += nlmsghdr.pack(nlmsghdr.size + len(body), msg_type,
+                                     flags | NLM_F_REQUEST | NLM_F_ACK, seq, 0) + body
+        sock.sendall(payload)
+
+        pending = set(range(1, len(messages) + 1))
+        failed = []
+        while len(pending) != 0:
+            for msg_type, seq, data in parse_messages(sock.recv(65536)):
+                if msg_type != NLMSG_ERROR:
+                    continue
+                pending.discard(seq)
+                code = -struct.unpack_from("=i", data)[0]
+                if code != 0 and code not in ignore:
+                    failed.append(code)
+    finally:
+        sock.close()
+
+    if len(failed) != 0:
+        logging.debug("netlink: %s of %s requests failed" %(len(failed), len(messages)))
+        raise OSError(failed[0], os.strerror(failed[0]))
+
+def dump_routes(table=None):
+    sock = open_socket()
+    routes = []
+    try:
+        body = rtmsg.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+        sock.sendall(nlmsghdr.pack(nlmsghdr.size + len(body), RTM_GETROUTE,
+                                   NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + body)
+        done = False
+        while done is False:
+            for msg_type, seq, data in parse_messages(sock.recv(65536)):
+                if msg_type == NLMSG_DONE:
+                    done = True
+                    break
+                elif msg_type == NLMSG_ERROR:
+                    code = -struct.unpack_from("=i", data)[0]
+                    raise OSError(code, os.strerror(code))
+                elif msg_type != RTM_NEWROUTE:
+                    continue
+                header = rtmsg.unpack_from(data)
+                attrs = parse_attrs(data[rtmsg.size:])
+                route = {"header" : header, "attrs" : attrs,
+                         "table" : struct.unpack("=I", attrs[RTA_TABLE])[0]
+                                   if RTA_TABLE in attrs else header[4],
+                         "dst_len" : header[1]
+                         }
+                if table is None or route["table"] == table:
+                    routes.append(route)
+    finally:
+        sock.close()
+    return routes
+
+def default_route():
+    for route in dump_routes(table=RT_TABLE_MAIN):
+        attrs = route["attrs"]
+        if route["dst_len"] == 0 and RTA_GATEWAY in attrs and RTA_OIF in attrs:
+            gateway = socket.inet_ntop(socket.AF_INET, attrs[RTA_GATEWAY])
+            index = struct.unpack("=I", attrs[RTA_OIF])[0]
+            return {"gateway" : gateway, "interface" : socket.if_indextoname(index)}
+    return None
+
+def flush_msgs(table):
+    messages = []
+    for route in dump_routes(table=table):
+        body = rtmsg.pack(*route["header"])
+        for attr_type, data in route["attrs"].items():
+            body += attr(attr_type, data)
+        messages.append((RTM_DELROUTE, 0, body))
+    return messages
+
+def flush_table(table):
+    transact(flush_msgs(table), ignore=(errno.ESRCH,))
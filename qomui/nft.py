@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import hashlib
+import logging
+from subprocess import check_output, CalledProcessError, STDOUT
+
+table = "qomui"
+nft_cmd = ["nft"]
+allow_chain = "QOMUI-ALLOW"
+server_sets = {"ipv4_addr" : "qomui_servers", "ipv6_addr" : "qomui_servers6"}
+server_ips = {"ipv4_addr" : [], "ipv6_addr" : []}
+#rules added at runtime (QOMUI-ALLOW entries, bypass groups) - carried into every rebuilt table
+runtime_rules = {}
+base_chains = {("filter", "INPUT") : "type filter hook input priority 0",
+               ("filter", "FORWARD") : "type filter hook forward priority 0",
+               ("filter", "OUTPUT") : "type filter hook output priority 0",
+               ("mangle", "INPUT") : "type filter hook input priority -150",
+               ("mangle", "OUTPUT") : "type route hook output priority -150",
+               ("nat", "OUTPUT") : "type nat hook output priority -100",
+               ("nat", "POSTROUTING") : "type nat hook postrouting priority 100"
+               }
+targets = {"ACCEPT" : "accept",
+           "DROP" : "drop",
+           "REJECT" : "reject",
+           "RETURN" : "return",
+           "MASQUERADE" : "masquerade",
+           "LOG" : "log"
+           }
+ignored_modules = ["state", "conntrack", "tcp", "udp", "icmp", "icmp6",
+                   "comment", "cgroup", "multiport", "mark", "connmark"
+                   ]
+option_aliases = {"--source" : "-s", "--src" : "-s", "--destination" : "-d", "--dst" : "-d",
+                  "--in-interface" : "-i", "--out-interface" : "-o", "--protocol" : "-p",
+                  "--jump" : "-j", "--match" : "-m", "--source-port" : "--sport",
+                  "--destination-port" : "--dport", "--source-ports" : "--sports",
+                  "--destination-ports" : "--dports", "--state" : "--ctstate"
+                  }
+header_options = ["-s", "-d", "-i", "-o", "-p"]
+#iptables-save adds these matches itself when -p is combined with port or type options
+implicit_modules = ["tcp", "udp", "icmp", "icmp6", "icmpv6", "ipv6-icmp"]
+icmp_types = {"echo-reply" : "0", "destination-unreachable" : "3", "source-quench" : "4",
+              "redirect" : "5", "echo-request" : "8", "time-exceeded" : "11",
+              "parameter-problem" : "12", "timestamp-request" : "13", "timestamp-reply" : "14"
+              }
+icmpv6_types = {"destination-unreachable" : "1", "packet-too-big" : "2", "time-exceeded" : "3",
+                "parameter-problem" : "4", "echo-request" : "128", "echo-reply" : "129",
+                "router-solicitation" : "133", "router-advertisement" : "134",
+                "neighbour-solicitation" : "135", "neighbor-solicitation" : "135",
+                "neighbour-advertisement" : "136", "neighbor-advertisement" : "136",
+                "redirect" : "137"
+                }
+default_rejects = ["icmp-port-unreachable", "icmp6-port-unreachable"]
+
+def chain_name(ipt_table, chain):
+    if ipt_table == "filter":
+        return chain.lower()
+    return "%s_%s" %(ipt_table, chain.lower())
+
+def split_rule(rule):
+    ipt_table = "filter"
+    cmd = list(rule)
+    if "-t" in cmd:
+        i = cmd.index("-t")
+        ipt_table = cmd[i+1]
+        cmd = cmd[:i] + cmd[i+2:]
+    return ipt_table, cmd
+
+def addr_family(addr):
+    if ":" in addr:
+        return "ip6"
+    return "ip"
+
+def mark_match(key, val, negate=""):
+    #iptables value/mask becomes a bitwise and
+    if "/" in val:
+        value, mask = val.split("/")
+        return "%s and %s %s%s" %(key, mask, negate or "== ", value)
+    return "%s %s%s" %(key, negate, val)
+
+def mark_set(key, spec):
+    if "--set-xmark" in spec:
+        value, mask = spec[spec.index("--set-xmark")+1].split("/")
+        keep = ~int(mask, 0) & 0xffffffff
+        return "%s set %s and 0x%08x or %s" %(key, key, keep, value)
+    return "%s set %s" %(key, spec[spec.index("--set-mark")+1])
+
+def translate(spec, tag=None):
+    expr = []
+    verdict = []
+    comment = None
+    proto = None
+    module = None
+    negate = ""
+    i = 0
+    while i < len(spec):
+        arg = spec[i]
+        try:
+            val = spec[i+1]
+        except IndexError:
+            val = None
+
+        if arg == "!":
+            negate = "!= "
+            i += 1
+            continue
+        elif arg in ("-i", "--in-interface"):
+            expr.append('iifname %s"%s"' %(negate, val.replace("+", "*")))
+        elif arg in ("-o", "--out-interface"):
+            expr.append('oifname %s"%s"' %(negate, val.replace("+", "*")))
+        elif arg in ("-s", "--source"):
+            expr.append("%s saddr %s%s" %(addr_family(val), negate, val))
+        elif arg in ("-d", "--destination"):
+            expr.append("%s daddr %s%s" %(addr_family(val), negate, val))
+        elif arg in ("-p", "--protocol"):
+            proto = {"icmpv6" : "ipv6-icmp"}.get(val, val)
+            expr.append("meta l4proto %s%s" %(negate, proto))
+        elif arg in ("--dport", "--destination-port", "--sport", "--source-port"):
+            direction = "dport" if arg.startswith("--d") else "sport"
+            expr.append("%s %s %s%s" %(proto, direction, negate, val.replace(":", "-")))
+        elif arg in ("--dports", "--sports"):
+            direction = arg[2:-1]
+            expr.append("%s %s %s{ %s }" %(proto, direction, negate, val.replace(":", "-").replace(",", ", ")))
+        elif arg in ("--state", "--ctstate"):
+            expr.append("ct state %s%s" %(negate, val.lower()))
+        elif arg == "--icmp-type":
+            expr.append("icmp type %s%s" %(negate, val))
+        elif arg == "--icmpv6-type":
+            expr.append("icmpv6 type %s%s" %(negate, val))
+        elif arg == "--cgroup":
+            expr.append("meta cgroup %s%s" %(negate, val))
+        elif arg == "--path":
+            level = len(val.strip("/").split("/"))
+            expr.append('socket cgroupv2 level %s %s"%s"' %(level, negate, val.strip("/")))
+        elif arg == "--mark" and module == "connmark":
+            expr.append(mark_match("ct mark", val, negate))
+        elif arg == "--mark":
+            expr.append(mark_match("meta mark", val, negate))
+        elif arg == "--comment":
+            comment = val
+        elif arg in ("-m", "--match"):
+            if val not in ignored_modules:
+                raise ValueError("unsupported match %s" %val)
+            module = val
+        elif arg in ("-j", "--jump"):
+            if val in targets:
+                verdict.append(targets[val])
+            elif val == "MARK":
+                verdict.append(mark_set("meta mark", spec))
+            elif val == "CONNMARK":
+                verdict.append(mark_set("ct mark", spec))
+            elif val == "REDIRECT":
+                verdict.append("redirect to :%s" %spec[spec.index("--to-ports")+1])
+            else:
+                verdict.append("jump %s" %chain_name("filter", val))
+        elif arg in ("--set-mark", "--set-xmark", "--to-ports"):
+            pass
+        else:
+            raise ValueError("unsupported option %s" %arg)
+        negate = ""
+        i += 2
+
+    if len(verdict) == 0:
+        #rules without a target are only there for their counters
+        verdict.append("counter")
+    if tag is not None:
+        comment = tag
+    if comment is not None:
+        verdict.append('comment "%s"' %comment.replace('"', "'"))
+    return " ".join(expr + verdict)
+
+def host_address(addr):
+    #iptables-save prints single hosts with /32 or /128
+    if ":" in addr and addr.endswith("/128"):
+        return addr[:-4]
+    elif ":" not in addr and addr.endswith("/32"):
+        return addr[:-3]
+    return addr
+
+def spec_key(spec):
+    #(option, values) pairs in the order iptables-save prints them - header
+    #options come first there, so only those are sorted
+    header = []
+    matches = []
+    negate = ""
+    i = 0
+    while i < len(spec):
+        if spec[i] == "!":
+            negate = "!"
+            i += 1
+            continue
+        option = option_aliases.get(spec[i], spec[i])
+        values = []
+        i += 1
+        while i < len(spec) and spec[i] != "!" and not spec[i].startswith("-"):
+            values.append(spec[i])
+            i += 1
+
+        if option == "-m" and len(values) == 1 and values[0] in implicit_modules:
+            negate = ""
+            continue
+        elif option == "-m" and values == ["state"]:
+            values = ["conntrack"]
+        elif option in ("-s", "-d"):
+            values = [",".join(host_address(a) for a in v.split(",")) for v in values]
+        elif option == "-p":
+            values = [{"icmpv6" : "ipv6-icmp", "icmp6" : "ipv6-icmp"}.get(v.lower(), v.lower()) for v in values]
+        elif option == "--ctstate":
+            values = [",".join(sorted(v.upper().split(","))) for v in values]
+        elif option == "--icmp-type":
+            values = [icmp_types.get(v, v) for v in values]
+        elif option == "--icmpv6-type":
+            values = [icmpv6_types.get(v, v) for v in values]
+        elif option == "--reject-with" and values in ([d] for d in default_rejects):
+            negate = ""
+            continue
+
+        pair = (negate + option, tuple(values))
+        if option in header_options:
+            header.append(pair)
+        else:
+            matches.append(pair)
+        negate = ""
+    return tuple(sorted(header)) + tuple(matches)
+
+def rule_tag(ipt_table, chain, spec):
+    key = repr((ipt_table, chain, spec_key(spec)))
+    return "qomui-%s" %hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+def render_ruleset(rules, rules_6):
+    chains = {("filter", allow_chain) : []}
+    policies = {}
+    for key in base_chains.keys():
+        chains[key] = []
+    for chain in ("INPUT", "OUTPUT"):
+        chains[("filter", chain)].append("jump %s" %chain_name("filter", allow_chain))
+    chains[("filter", "OUTPUT")].append("ip daddr @%s accept" %server_sets["ipv4_addr"])
+    chains[("filter", "OUTPUT")].append("ip6 daddr @%s accept" %server_sets["ipv6_addr"])
+
+    for family, family_rules in (("ipv4", rules), ("ipv6", rules_6)):
+        for rule in family_rules:
+            ipt_table, cmd = split_rule(rule)
+            if len(cmd) == 0 or cmd[0] in ("-F", "-X"):
+                continue
+            elif cmd[0] == "-P":
+                policies.setdefault((ipt_table, cmd[1]), {})[family] = cmd[2].lower()
+            elif cmd[0] in ("-A", "-I"):
+                spec = cmd[2:]
+                if cmd[0] == "-I" and len(spec) > 0 and spec[0].isdigit():
+                    spec = spec[1:]
+                expr = "meta nfproto %s %s" %(family, translate(spec))
+                chain_rules = chains.setdefault((ipt_table, cmd[1]), [])
+                if cmd[0] == "-I":
+                    chain_rules.insert(0, expr)
+                else:
+                    chain_rules.append(expr)
+            else:
+                raise ValueError("unsupported command %s" %cmd[0])
+
+    for (family, tag), (ipt_table, chain, verb, spec) in runtime_rules.items():
+        expr = "meta nfproto %s %s" %(family, translate(spec, tag=tag))
+        chain_rules = chains.setdefault((ipt_table, chain), [])
+        if verb == "insert":
+            chain_rules.insert(0, expr)
+        else:
+            chain_rules.append(expr)
+
+    payload = ["table inet %s" %table,
+               "delete table inet %s" %table,
+               "table inet %s {" %table
+               ]
+    for addr_type, name in server_sets.items():
+        payload.append("    set %s {" %name)
+        payload.append("        type %s;" %addr_type)
+        if len(server_ips[addr_type]) != 0:
+            payload.append("        elements = { %s }" %", ".join(server_ips[addr_type]))
+        payload.append("    }")
+    for key, chain_rules in chains.items():
+        payload.append("    chain %s {" %chain_name(*key))
+        if key in base_chains:
+            family_policy = policies.get(key, {})
+            policy = "accept"
+            if len(set(family_policy.values())) == 1 and len(family_policy) == 2:
+                policy = list(family_policy.values())[0]
+            payload.append("        %s; policy %s;" %(base_chains[key], policy))
+            for family, p in family_policy.items():
+                if p != policy:
+                    chain_rules = chain_rules + ["meta nfproto %s %s" %(family, p)]
+        payload.extend("        %s" %r for r in chain_rules)
+        payload.append("    }")
+    payload.append("}")
+    return "\n".join(payload) + "\n"
+
+def run_nft(payload):
+    try:
+        check_output(nft_cmd + ["-f", "-"], input=payload.encode("utf-8"), stderr=STDOUT)
+        return True
+    except CalledProcessError as e:
+        logging.warning("nft: transaction rejected - %s" %e.output.decode("utf-8").strip())
+    except FileNotFoundError:
+        logging.warning("nft: command not found")
+    return False
+
+def apply_ruleset(rules, rules_6):
+    try:
+        payload = render_ruleset(rules, rules_6)
+    except (ValueError, IndexError, AttributeError) as e:
+        logging.warning("nft: could not translate firewall configuration - %s" %e)
+        return False
+    if run_nft(payload) is True:
+        logging.debug("nft: loaded table inet %s in one transaction" %table)
+        return True
+    return False
+
+def add_rules(rules, family="ipv4"):
+    payload = []
+    deletions = []
+    listings = {}
+    added = {}
+    success = True
+    for rule in rules:
+        ipt_table, cmd = split_rule(rule)
+        try:
+            chain = chain_name(ipt_table, cmd[1])
+            spec = cmd[2:]
+            if cmd[0] == "-I" and len(spec) > 0 and spec[0].isdigit():
+                spec = spec[1:]
+            tag = rule_tag(ipt_table, cmd[1], spec)
+            if cmd[0] == "-D":
+                deletions.append((chain, tag))
+                added.pop((family, tag), None)
+            elif cmd[0] in ("-A", "-I"):
+                verb = "insert" if cmd[0] == "-I" else "add"
+                added[(family, tag)] = (ipt_table, cmd[1], verb, list(spec))
+                if listings.get(chain) is None:
+                    listings[chain] = list_chain(chain)
+                if len(find_handles(chain, tag, family=family, listing=listings[chain])) != 0:
+                    logging.debug("nft: %s already exists" %(rule,))
+                    continue
+                payload.append("%s rule inet %s %s meta nfproto %s %s" %(verb, table, chain, family,
+                                                                       translate(spec, tag=tag)))
+        except (ValueError, IndexError, AttributeError) as e:
+            logging.warning("nft: failed to translate %s - %s" %(rule, e))
+            success = False
+
+    for chain, tag in deletions:
+        if listings.get(chain) is None:
+            listings[chain] = list_chain(chain)
+        for handle in find_handles(chain, tag, family=family, listing=listings[chain]):
+            payload.append("delete rule inet %s %s handle %s" %(table, chain, handle))
+
+    if len(payload) != 0 and run_nft("\n".join(payload) + "\n") is False:
+        return False
+    elif len(payload) != 0:
+        logging.debug("nft: applied %s rule changes" %len(payload))
+    for chain, tag in deletions:
+        runtime_rules.pop((family, tag), None)
+    runtime_rules.update(added)
+    return success
+
+def carried(rule, family="ipv4"):
+    #whether render_ruleset already loads the rule with the profile
+    ipt_table, cmd = split_rule(rule)
+    spec = cmd[2:]
+    if cmd[0] == "-I" and len(spec) > 0 and spec[0].isdigit():
+        spec = spec[1:]
+    return (family, rule_tag(ipt_table, cmd[1], spec)) in runtime_rules
+
+def set_servers(v4, v6):
+    server_ips["ipv4_addr"] = v4
+    server_ips["ipv6_addr"] = v6
+    if table_exists() is False:
+        #elements are loaded with the next ruleset
+        return True
+    payload = []
+    for addr_type, name in server_sets.items():
+        payload.append("flush set inet %s %s" %(table, name))
+        if len(server_ips[addr_type]) != 0:
+            payload.append("add element inet %s %s { %s }" %(table, name,
+                                                            ", ".join(server_ips[addr_type])))
+    return run_nft("\n".join(payload) + "\n")
+
+def list_chain(chain):
+    try:
+        return check_output(nft_cmd + ["-a", "list", "chain", "inet", table, chain],
+                            stderr=STDOUT).decode("utf-8")
+    except (CalledProcessError, FileNotFoundError):
+        logging.debug("nft: could not list chain %s" %chain)
+        return ""
+
+def find_handles(chain, tag, family=None, listing=None):
+    #rules added by add_rules carry their tag as comment
+    if listing is None:
+        listing = list_chain(chain)
+    handles = []
+    for line in listing.split("\n"):
+        if '"%s"' %tag in line and "# handle" in line:
+            if family is None or "meta nfproto %s" %family in line:
+                handles.append(line.split("# handle")[1].strip())
+    return handles
+
+def table_exists():
+    try:
+        check_output(nft_cmd + ["list", "table", "inet", table], stderr=STDOUT)
+        return True
+    except (CalledProcessError, FileNotFoundError):
+        return False
+
+def delete_table():
+    #the iptables backend keeps its own runtime rules
+    runtime_rules.clear()
+    if table_exists() is True:
+        if run_nft("delete table inet %s\n" %table) is True:
+            logging.info("nft: removed table inet %s" %table)
+
+def read_counters():
+    counters = {}
+    try:
+        listing = check_output(nft_cmd + ["list", "table", "inet", table], stderr=STDOUT).decode("utf-8")
+    except (CalledProcessError, FileNotFoundError):
+        return counters
+    for line in listing.split("\n"):
+        match = re.search(r'counter packets (\d+) bytes (\d+).*comment "([^"]+)"', line)
+        if match is not None:
+            counters[match.group(3)] = (int(match.group(1)), int(match.group(2)))
+    return counters
+
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from subprocess import CalledProcessError, check_output
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import re
+import json
+import random
+import time
+import socket
+import struct
+import logging
+import threading
+import statistics
+
+max_in_flight = 64
+probe_timeout = 1.0
+history_ttl = 3600
+hot_ttl = 300
+best_n = 10
+probe_budget = 120
+samples = 3
+sample_interval = 0.2
+ewma_alpha = 0.3
+#unanswered resets after which a provider is assumed to require tls-auth/tls-crypt
+silent_after = 3
+icmp_echo = struct.Struct("!BBHHH")
+#P_CONTROL_HARD_RESET_CLIENT_V2 / P_CONTROL_HARD_RESET_SERVER_V2, key id 0
+ovpn_reset_client = 7 << 3
+ovpn_reset_server = 8 << 3
+#guards history dicts shared between the gui and a running sweep
+history_lock = threading.Lock()
+
+def server_ip(val):
+    try:
+        return val["ip"]
+    except KeyError:
+        return val["prim_ip"]
+
+def ping(ip, interface):
+    try:
+        pinger = check_output(["ping", "-c", "1", "-W", "1", "-I", "%s" %interface, "%s" %ip]).decode("utf-8")
+        latencysearch = re.search(r'rtt min/avg/max/mdev = \d+(?:\.\d+)?/\d+(?:\.\d+)?/\d+(?:\.\d+)?/\d+(?:\.\d+)?', pinger)
+        if latencysearch != None:
+            return float(str(latencysearch.group()).split("/")[4])
+    except (CalledProcessError, FileNotFoundError):
+        pass
+    return 999.0
+
+def checksum(data):
+    if len(data) % 2 == 1:
+        data += b"\0"
+    total = sum(struct.unpack("!%sH" %(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def bind_device(sock, interface):
+    #unprivileged SO_BINDTODEVICE needs linux 5.7 - without it probes follow the vpn route
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode("utf-8"))
+
+def can_bind(interface):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            bind_device(sock, interface)
+        return True
+    except OSError:
+        return False
+
+def tcp_connect(ip, port, interface, timeout=probe_timeout):
+    family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        bind_device(sock, interface)
+        sock.settimeout(timeout)
+        start = time.perf_counter()
+        try:
+            sock.connect((ip, int(port)))
+            return round((time.perf_counter() - start) * 1000, 3)
+        except (OSError, ValueError):
+            return 999.0
+
+def openvpn_reset(ip, port, interface, timeout=probe_timeout):
+    #servers using tls-auth/tls-crypt silently drop resets without a valid hmac
+    family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+    session = struct.pack("!Q", random.getrandbits(64))
+    packet = struct.pack("!B", ovpn_reset_client) + session + b"\0" + struct.pack("!I", 0)
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        bind_device(sock, interface)
+        sock.settimeout(timeout)
+        try:
+            sock.connect((ip, int(port)))
+            start = time.perf_counter()
+            sock.send(packet)
+            while True:
+                reply = sock.recv(1024)
+                #the server acks our session id
+                if len(reply) > 0 and reply[0] & 0xf8 == ovpn_reset_server and session in reply:
+                    return round((time.perf_counter() - start) * 1000, 3)
+        except (OSError, ValueError):
+            return 999.0
+
+def save_history(path, history, server_dict):
+    #[timestamp, median, loss, jitter, ewma] per server - servers that were removed are dropped
+    with history_lock:
+        compact = {k : v for k, v in history.items() if k in server_dict}
+    try:
+        with open("%s.tmp" %path, "w") as f:
+            json.dump(compact, f, separators=(",", ":"))
+        os.replace("%s.tmp" %path, path)
+    except OSError as e:
+        logging.debug("Latency check: could not save history - %s" %e)
+
+def stale(history, keys, ttl=history_ttl, rank=None):
+    #never probed first, then oldest first - ties go to the nearest server
+    if rank is None:
+        rank = {}
+    now = time.time()
+    expired = []
+    for k in keys:
+        try:
+            timestamp = float(history[k][0])
+        except (KeyError, IndexError, TypeError, ValueError):
+            timestamp = 0
+        if now - timestamp >= ttl:
+            expired.append((timestamp, rank.get(k, float("inf")), k))
+    return [k for timestamp, r, k in sorted(expired)]
+
+def schedule(history, server_dict, priority=(), budget=probe_budget, 
+             hot=hot_ttl, cold=history_ttl, best=best_n, rank=None):
+    #favourites, current servers and the best ranked ones are refreshed often - the rest rarely
+    scores = ((history_score(v), k) for k, v in history.items() if k in server_dict)
+    ranked = sorted((score, k) for score, k in scores if score is not None)
+    hot_keys = set(k for k in priority if k in server_dict)
+    hot_keys.update(k for score, k in ranked[:best] if score != 999)
+    cold_keys = [k for k in server_dict if k not in hot_keys]
+    due = stale(history, sorted(hot_keys), ttl=hot, rank=rank) + stale(history, cold_keys, ttl=cold, rank=rank)
+    return due[:budget]
+
+def sample_stats(results, previous=None):
+    received = [r for r in results if r != 999]
+    loss = round(100.0 * (len(results) - len(received)) / len(results), 1)
+    if len(received) == 0:
+        return {"median" : 999.0, "jitter" : 0.0, "loss" : loss, "ewma" : 999.0}
+    median = round(statistics.median(received), 3)
+    #mean difference between consecutive samples as in rfc 3550
+    jitter = 0.0
+    if len(received) > 1:
+        jitter = round(statistics.mean(abs(a - b) for a, b in zip(received, received[1:])), 3)
+    ewma = median
+    try:
+        if previous[4] != 999:
+            ewma = round(ewma_alpha * median + (1 - ewma_alpha) * previous[4], 3)
+    except (IndexError, KeyError, TypeError):
+        pass
+    return {"median" : median, "jitter" : jitter, "loss" : loss, "ewma" : ewma}
+
+def history_score(entry):
+    #entries written before multi-sample stats only carry [timestamp, rtt, loss] - 
+    #anything else in an old or edited latency.json has no score
+    if not isinstance(entry, (list, tuple)):
+        return None
+    try:
+        return float(entry[4] if len(entry) > 4 else entry[1])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+def format_latency(latency_float, stats=None):
+    if latency_float == 999:
+        return "N.A."
+    elif stats is not None and stats["loss"] > 0:
+        return "{0:.1f} ms - {1:.0f}% loss".format(latency_float, stats["loss"])
+    return "{0:.1f} ms".format(latency_float)
+
+
+class IcmpProber(object):
+    #one socket for all echo requests of a sweep - replies are matched by sequence number
+    def __init__(self, interface):
+        self.interface = interface
+        self.ident = os.getpid() & 0xffff
+        self.seq = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        try:
+            #unprivileged ping sockets - see net.ipv4.ping_group_range
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw = False
+        except PermissionError:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        try:
+            bind_device(self.sock, interface)
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.settimeout(0.2)
+        self.running = True
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+
+    def close(self):
+        self.running = False
+        self.receiver.join()
+        self.sock.close()
+
+    def receive(self):
+        while self.running is True:
+            try:
+                data = self.sock.recv(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            received = time.perf_counter()
+            if self.raw is True:
+                data = data[(data[0] & 0x0f) * 4:]
+            try:
+                icmp_type, code, csum, ident, seq = icmp_echo.unpack_from(data)
+            except struct.error:
+                continue
+            #the kernel rewrites the id of datagram sockets
+            if icmp_type != 0 or (self.raw is True and ident != self.ident):
+                continue
+            with self.lock:
+                waiter = self.pending.get(seq)
+            if waiter is not None:
+                waiter[1] = received
+                waiter[2].set()
+
+    def ping(self, ip, timeout=probe_timeout):
+        return self.ping_many(ip, count=1, timeout=timeout)[0]
+
+    def ping_many(self, ip, count=samples, interval=sample_interval, timeout=probe_timeout):
+        #requests go out every interval without waiting for replies
+        waiters = []
+        try:
+            for i in range(count):
+                if i != 0:
+                    time.sleep(interval)
+                with self.lock:
+                    self.seq = (self.seq + 1) & 0xffff
+                    seq = self.seq
+                    waiter = [0, None, threading.Event(), seq]
+                    self.pending[seq] = waiter
+                waiters.append(waiter)
+                payload = struct.pack("!d", time.time()) + b"qomui" * 8
+                packet = icmp_echo.pack(8, 0, 0, self.ident, seq) + payload
+                packet = icmp_echo.pack(8, 0, checksum(packet), self.ident, seq) + payload
+                waiter[0] = time.perf_counter()
+                self.sock.sendto(packet, (ip, 0))
+            deadline = waiters[-1][0] + timeout
+            for waiter in waiters:
+                waiter[2].wait(max(deadline - time.perf_counter(), 0))
+        except OSError as e:
+            logging.debug("Latency check: echo request to %s failed - %s" %(ip, e))
+        finally:
+            with self.lock:
+                for waiter in waiters:
+                    self.pending.pop(waiter[3], None)
+
+        results = []
+        for waiter in waiters:
+            if waiter[1] is not None:
+                results.append(round((waiter[1] - waiter[0]) * 1000, 3))
+            else:
+                results.append(999.0)
+        return results + [999.0] * (count - len(results))
+
+
+class Sweep(object):
+    #probes a list of servers - results go to the emit callback as they arrive
+    def __init__(self, server_dict, interface, workers=max_in_flight, endpoints=None,
+                 keys=None, history=None, history_file=None, count=samples):
+        self.server_dict = server_dict
+        self.interface = interface
+        self.workers = workers
+        self.endpoints = endpoints
+        self.keys = keys
+        self.history = history
+        self.history_file = history_file
+        self.count = count
+        self.silent = {}
+        self.answered = set()
+        self.silent_lock = threading.Lock()
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def probe(self, k, ip):
+        if self.running is False:
+            return k, None
+        elif self.endpoints is not None and k in self.endpoints:
+            ip, protocol, port = self.endpoints[k]
+            if protocol.upper() == "TCP":
+                return k, self.repeat(tcp_connect, ip, port, self.interface)
+            provider = self.server_dict.get(k, {}).get("provider")
+            if self.silent.get(provider, 0) < silent_after or provider in self.answered:
+                #a server that ignores the first reset will ignore the others too
+                first = openvpn_reset(ip, port, self.interface)
+                if first != 999:
+                    self.answered.add(provider)
+                    return k, [first] + self.repeat(openvpn_reset, ip, port, self.interface, count=self.count - 1)
+                with self.silent_lock:
+                    self.silent[provider] = self.silent.get(provider, 0) + 1
+        if self.prober is not None and ":" not in ip:
+            return k, self.prober.ping_many(ip, count=self.count)
+        return k, self.repeat(ping, ip, self.interface)
+
+    def repeat(self, probe, *args, count=None):
+        if count is None:
+            count = self.count
+        results = []
+        for i in range(count):
+            if i != 0:
+                time.sleep(sample_interval)
+            if self.running is False:
+                break
+            results.append(probe(*args))
+        return results
+
+    def run(self, emit):
+        #copy - server_dict may change while the sweep is running
+        if self.keys is None:
+            targets = [(k, server_ip(v)) for k, v in list(self.server_dict.items())]
+        else:
+            targets = [(k, server_ip(self.server_dict[k])) for k in self.keys if k in self.server_dict]
+        self.prober = None
+        if can_bind(self.interface) is False:
+            #only ping -I can still pin the probes to the physical interface
+            logging.warning("Latency check: cannot bind probes to %s - using ping -I" %self.interface)
+            self.endpoints = None
+        else:
+            try:
+                self.prober = IcmpProber(self.interface)
+            except OSError as e:
+                logging.debug("Latency check: falling back to ping - %s" %e)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.probe, k, ip) for k, ip in targets]
+            try:
+                for future in as_completed(futures):
+                    if self.running is False:
+                        break
+                    k, results = future.result()
+                    if results is not None and len(results) != 0:
+                        previous = None
+                        if self.history is not None:
+                            with history_lock:
+                                previous = self.history.get(k)
+                        stats = sample_stats(results, previous)
+                        if self.history is not None:
+                            with history_lock:
+                                self.history[k] = [int(time.time()), stats["median"], stats["loss"],
+                                                   stats["jitter"], stats["ewma"]]
+                        emit((k, format_latency(stats["ewma"], stats),
+                                              stats["ewma"], stats))
+            except RuntimeError:
+                logging.debug("RuntimeError: Latency check is already running")
+            finally:
+                for future in futures:
+                    future.cancel()
+        if self.prober is not None:
+            self.prober.close()
+
+        if self.history is not None and self.history_file is not None:
+            save_history(self.history_file, self.history, self.server_dict)
+        if self.running is True:
+            logging.debug("Latency check: probed %s servers" %len(targets))
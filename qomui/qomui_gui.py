@@ -13,15 +13,14 @@ import random
 import logging
 from PyQt5 import QtCore, QtGui, Qt, QtWidgets
 from dbus.mainloop.pyqt5 import DBusQtMainLoop
-from subprocess import CalledProcessError, check_call, check_output, Popen
+from subprocess import CalledProcessError, SubprocessError, check_call, check_output, Popen
 import psutil
 import shlex
 import glob
 import configparser
 import requests
-import bisect
 
-from qomui import update, latency
+from qomui import update, latency, probe, bypass, geo
 
 
 try:
@@ -57,7 +56,8 @@ SUPPORTED_PROVIDERS = ["Airvpn", "Mullvad", "PIA"]
 JSON_FILE_LIST = [("config_dict", "%s/config.json" %ROOTDIR),
                   ("server_dict", "%s/server.json" %HOMEDIR), 
                   ("protocol_dict", "%s/protocol.json" %HOMEDIR), 
-                  ("bypass_dict", "%s/bypass_apps.json" %HOMEDIR)
+                  ("bypass_dict", "%s/bypass_apps.json" %HOMEDIR),
+                  ("latency_history", "%s/latency.json" %HOMEDIR)
                   ]
 
 
@@ -97,6 +97,7 @@ class favouriteButton(QtWidgets.QAbstractButton):
 
 
 class QomuiGui(QtWidgets.QWidget):
+    bypass_failed = QtCore.pyqtSignal(str, int)
     status = "inactive"
     server_dict = {}
     protocol_dict = {}
@@ -107,6 +108,11 @@ class QomuiGui(QtWidgets.QWidget):
     hop_log_monitor = 0
     hop_server_dict = None
     bypass_dict = {}
+    latency_history = {}
+    latency_values = {}
+    latency_labels = {}
+    latency_pending = {}
+    server_distance = {}
     config_dict = {}
     config_list = [
                    "firewall",
@@ -116,6 +122,7 @@ class QomuiGui(QtWidgets.QWidget):
                    "alt_dns",
                    "bypass",
                    "ping",
+                   "handshake",
                    "simpletray"
                    ]
     
@@ -179,6 +186,7 @@ class QomuiGui(QtWidgets.QWidget):
         handler = DbusLogHandler(self.qomui_service)
         handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
         self.logger.addHandler(handler)
+        self.bypass_failed.connect(self.bypass_exited)
         primay_screen = QtWidgets.QDesktopWidget().primaryScreen()
         primary_screen_geometry = QtWidgets.QDesktopWidget().availableGeometry(primay_screen)
         positioning = primary_screen_geometry.bottomRight()
@@ -366,6 +374,16 @@ class QomuiGui(QtWidgets.QWidget):
         self.pingOptLabel.setIndent(20)
         self.pingOptLabel.setFont(italic_font)
         self.verticalLayout_5.addWidget(self.pingOptLabel)
+        self.handshakeOptCheck = QtWidgets.QCheckBox(self.optionsTab)
+        self.handshakeOptCheck.setFont(bold_font)
+        self.handshakeOptCheck.setObjectName(_fromUtf8("handshakeOptCheck"))
+        self.verticalLayout_5.addWidget(self.handshakeOptCheck)
+        self.handshakeOptLabel = QtWidgets.QLabel(self.optionsTab)
+        self.handshakeOptLabel.setObjectName(_fromUtf8("handshakeOptLabel"))
+        self.handshakeOptLabel.setWordWrap(True)
+        self.handshakeOptLabel.setIndent(20)
+        self.handshakeOptLabel.setFont(italic_font)
+        self.verticalLayout_5.addWidget(self.handshakeOptLabel)
         self.ipv6_disableOptCheck = QtWidgets.QCheckBox(self.optionsTab)
         self.ipv6_disableOptCheck.setFont(bold_font)
         self.ipv6_disableOptCheck.setObjectName(_fromUtf8("ipv6_disableOptCheck"))
@@ -740,6 +758,7 @@ class QomuiGui(QtWidgets.QWidget):
         self.firewallOptCheck.setText(_translate("Form", "Activate Firewall     ", None))
         self.bypassOptCheck.setText(_translate("Form", "Allow OpenVPN bypass", None))
         self.pingOptCheck.setText(_translate("Form", "Perform latency check", None))
+        self.handshakeOptCheck.setText(_translate("Form", "Latency check: measure connect time", None))
         self.ipv6_disableOptCheck.setText(_translate("Form", "Disable IPv6", None))
         self.alt_dnsOptCheck.setText(_translate("Form", "Use always", None))
         self.alt_dnsOptLabel.setText(_translate("Form", "Alternative DNS Servers:", None))
@@ -795,6 +814,9 @@ class QomuiGui(QtWidgets.QWidget):
         self.pingOptLabel.setText(_translate("Form", 
                                           "Sort servers by latency - allow ping", 
                                           None))
+        self.handshakeOptLabel.setText(_translate("Form", 
+                                          "Probe the selected OpenVPN port and protocol instead of ping", 
+                                          None))
         self.bypassOptLabel.setText(_translate("Form", 
                                           "Allow applications to run outside VPN tunnel", 
                                           None))
@@ -930,6 +952,7 @@ class QomuiGui(QtWidgets.QWidget):
     
     def shutdown(self):
         self.tray.hide()
+        self.stop_latencies()
         self.kill()
         sys.exit()
         
@@ -949,6 +972,7 @@ class QomuiGui(QtWidgets.QWidget):
                              )
         if ret == 1:
             self.tray.hide()
+            self.stop_latencies()
             self.kill()
             event.accept()
         elif ret == 0:
@@ -1022,6 +1046,7 @@ class QomuiGui(QtWidgets.QWidget):
             pass
         
         self.setOptiontab(self.config_dict)
+        self.allow_servers()
         self.pop_boxes(country='All countries')
         self.pop_bypassAppList()
         self.connect_last_server()
@@ -1050,7 +1075,8 @@ class QomuiGui(QtWidgets.QWidget):
         self.setOptiontab(self.config_dict)
             
     def applyoptions(self):
-        temp_config_dict = {}
+        #keep options without a widget, e.g. latency_ttl or location
+        temp_config_dict = dict(self.config_dict)
         temp_config_dict["alt_dns1"] = self.altDnsEdit1.text()
         temp_config_dict["alt_dns2"] = self.altDnsEdit2.text()
         
@@ -1079,6 +1105,7 @@ class QomuiGui(QtWidgets.QWidget):
                                             "Configuration updated successfully",
                                             QtWidgets.QMessageBox.Ok)
             
+            self.config_dict = temp_config_dict
             if temp_config_dict["ping"] == 1:
                 self.get_latencies()
                 
@@ -1087,8 +1114,6 @@ class QomuiGui(QtWidgets.QWidget):
             else:
                 self.bypassTabBt.setVisible(False)
 
-            self.config_dict = temp_config_dict
-
         except CalledProcessError as e:
             self.logger.info("Non-zero exit status: configuration changes not applied")
             QtWidgets.QMessageBox.information(self,
@@ -1100,7 +1125,7 @@ class QomuiGui(QtWidgets.QWidget):
         if networkstate == 70 or networkstate == 60:
             self.logger.info("Detected new network connection")
             self.qomui_service.save_default_dns()
-            self.get_latencies()
+            self.get_latencies(full=True)
             if self.ovpn_dict is not None:
                 self.establish_connection(self.ovpn_dict)
                 self.qomui_service.bypass(self.get_user_group())
@@ -1250,6 +1275,7 @@ class QomuiGui(QtWidgets.QWidget):
             self.qomui_service.delete_provider(provider)
             with open ("%s/server.json" % HOMEDIR, "w") as s:
                 json.dump(self.server_dict, s)
+            self.allow_servers()
             self.pop_boxes()
    
     def update_bar(self, text, provider):
@@ -1301,8 +1327,23 @@ class QomuiGui(QtWidgets.QWidget):
         
         with open ("%s/protocol.json" % HOMEDIR, "w") as p:
             json.dump(self.protocol_dict, p) 
+        self.allow_servers()
         self.pop_boxes()
     
+    def allow_servers(self):
+        ips = set()
+        for k, v in self.server_dict.items():
+            for key in ["ip", "prim_ip", "alt_ip"]:
+                try:
+                    ips.add(v[key])
+                except KeyError:
+                    pass
+        try:
+            if self.qomui_service.allow_servers(sorted(ips)) is False:
+                self.logger.warning("Qomui-service refused to update the allowlist of VPN servers")
+        except dbus.exceptions.DBusException:
+            self.logger.warning("Could not update firewall allowlist of VPN servers")
+    
     def del_single_server(self):
         for item in self.serverListWidget.selectedItems():
             data = item.data(QtCore.Qt.UserRole)
@@ -1310,7 +1351,10 @@ class QomuiGui(QtWidgets.QWidget):
             try:
                 self.server_dict.pop(data, None)
                 self.serverListWidget.takeItem(index)
-            except KeyError:
+                self.index_list.remove(data)
+                self.latency_values.pop(data, None)
+                self.latency_labels.pop(data, None)
+            except (KeyError, ValueError):
                 pass
         with open ("%s/server.json" % HOMEDIR, "w") as s:
             json.dump(self.server_dict, s)
@@ -1363,32 +1407,149 @@ class QomuiGui(QtWidgets.QWidget):
         except KeyError:
             pass
         
-    def get_latencies(self):
+    def get_latencies(self, full=False, scheduled=False):
         gateway = self.qomui_service.default_gateway_check()["interface"]
         if gateway != "None": 
-            self.latency_list = []
-            self.PingThread = latency.LatencyCheck(self.server_dict, gateway)
+            self.stop_latencies()
+            self.latency_started = True
+            try:
+                self.scheduleTimer.isActive()
+            except AttributeError:
+                self.scheduleTimer = QtCore.QTimer(self)
+                self.scheduleTimer.timeout.connect(self.scheduled_latencies)
+                self.scheduleTimer.start(60000)
+            with probe.history_lock:
+                cached = {k : probe.history_score(v) for k, v in self.latency_history.items()}
+            for k in list(self.server_dict.keys()):
+                if k not in self.latency_values and cached.get(k) is not None:
+                    self.display_latency((k, probe.format_latency(cached[k]), cached[k]))
+            self.apply_latencies()
+            if full is True:
+                keys = sorted(self.server_dict.keys(), 
+                              key=lambda k: self.server_distance.get(k, math.inf))
+            else:
+                with probe.history_lock:
+                    history = dict(self.latency_history)
+                keys = probe.schedule(history, self.server_dict,
+                                        priority=self.probe_priority(),
+                                        budget=self.config_dict.get("latency_budget", probe.probe_budget),
+                                        hot=self.config_dict.get("latency_hot_ttl", probe.hot_ttl),
+                                        cold=self.config_dict.get("latency_ttl", probe.history_ttl),
+                                        rank=self.server_distance)
+                if len(keys) == 0:
+                    if scheduled is False:
+                        self.check_update()
+                    return
+            endpoints = None
+            if self.config_dict.get("handshake", 0) == 1:
+                endpoints = self.probe_endpoints()
+            self.PingThread = latency.LatencyCheck(self.server_dict, gateway, endpoints=endpoints,
+                                                   keys=keys, history=self.latency_history,
+                                                   history_file="%s/latency.json" %HOMEDIR)
             self.PingThread.lat_signal.connect(self.display_latency)
-            self.PingThread.finished.connect(self.check_update)
+            if scheduled is False:
+                self.PingThread.finished.connect(self.check_update)
             self.PingThread.start()
+
+    def scheduled_latencies(self):
+        if self.config_dict.get("ping", 0) != 1:
+            return
+        elif getattr(self, "latency_started", False) is False:
+            #the first sweep comes from get_latencies
+            return
+        elif getattr(self, "PingThread", None) is not None and self.PingThread.isRunning() is True:
+            return
+        try:
+            self.get_latencies(scheduled=True)
+        except dbus.exceptions.DBusException:
+            pass
+
+    def probe_priority(self):
+        priority = [k for k, v in self.server_dict.items() if v.get("favourite") == "on"]
+        for current in (getattr(self, "ovpn_dict", None), self.hop_server_dict):
+            try:
+                priority.append(current["name"])
+            except (KeyError, TypeError):
+                pass
+        return priority
+
+    def probe_endpoints(self):
+        endpoints = {}
+        for k, v in self.server_dict.items():
+            provider = v["provider"]
+            try:
+                if provider in SUPPORTED_PROVIDERS:
+                    mode = self.protocol_dict[provider].get("selected", "protocol_1")
+                    selected = self.protocol_dict[provider][mode]
+                else:
+                    selected = self.protocol_dict[provider]
+                ip = probe.server_ip(v)
+                if provider == "Airvpn" and selected["ip"] == "Alternative":
+                    ip = v["alt_ip"]
+                endpoints[k] = (ip, selected["protocol"], selected["port"])
+            except KeyError:
+                pass
+        return endpoints
+
+    def stop_latencies(self):
+        try:
+            if self.PingThread.isRunning() is True:
+                self.PingThread.lat_signal.disconnect(self.display_latency)
+                try:
+                    self.PingThread.finished.disconnect(self.check_update)
+                except TypeError:
+                    pass
+                self.PingThread.stop()
+                self.PingThread.wait()
+        except AttributeError:
+            pass
         
     def display_latency(self, result):
-        hidden = False
-        server = result[0]
-        latency_string = result[1]
-        latency_float = result[2]
-        old_index = self.index_list.index(server)
-        bisect.insort(self.latency_list, latency_float)
-        update_index = self.latency_list.index(latency_float)
-        rm = self.index_list.index(server)
-        self.index_list.pop(rm)
-        self.index_list.insert(update_index, server)
-        if getattr(self, server).isHidden() == True:
-            hidden = True
-        self.serverListWidget.takeItem(old_index)
-        self.add_server_widget(server, self.server_dict[server], insert=update_index)
-        self.serverListWidget.setRowHidden(update_index, hidden)
-        getattr(self, server).display_latency(latency_string)
+        #results are collected and applied in batches - see apply_latencies
+        self.latency_pending[result[0]] = result
+        try:
+            if self.latencyTimer.isActive() is False:
+                self.latencyTimer.start()
+        except AttributeError:
+            self.latencyTimer = QtCore.QTimer(self)
+            self.latencyTimer.setSingleShot(True)
+            self.latencyTimer.setInterval(250)
+            self.latencyTimer.timeout.connect(self.apply_latencies)
+            self.latencyTimer.start()
+
+    def apply_latencies(self):
+        pending = self.latency_pending
+        self.latency_pending = {}
+        if len(pending) == 0:
+            return
+        for server, result in pending.items():
+            if server not in self.server_dict:
+                continue
+            self.latency_values[server] = result[2]
+            self.latency_labels[server] = result[1]
+            getattr(self, server).display_latency(result[1])
+
+        for row in range(self.serverListWidget.count()):
+            item = self.serverListWidget.item(row)
+            key = item.data(QtCore.Qt.UserRole)
+            if key in pending:
+                item.setData(ServerItem.SortRole, self.sort_key(key))
+        self.sort_servers()
+
+    def sort_servers(self):
+        #sorting moves the existing row widgets instead of recreating them
+        self.serverListWidget.sortItems()
+        self.index_list = []
+        for row in range(self.serverListWidget.count()):
+            key = self.serverListWidget.item(row).data(QtCore.Qt.UserRole)
+            self.index_list.append(key)
+            self.serverListWidget.setRowHidden(row, getattr(self, key).isHidden())
+
+    def sort_key(self, key):
+        try:
+            return (0, self.latency_values[key], key.upper())
+        except KeyError:
+            return (1, self.server_distance.get(key, math.inf), key.upper())
     
     def show_favourite_servers(self, state):
         self.randomSeverBt.setVisible(True)
@@ -1417,8 +1578,14 @@ class QomuiGui(QtWidgets.QWidget):
             self.favouriteButton.setChecked(False)
         if display == "all":
             self.index_list = []
+            #measured latencies survive a rebuild - only removed servers are dropped
+            self.latency_values = {k : v for k, v in self.latency_values.items() if k in self.server_dict}
+            self.latency_labels = {k : v for k, v in self.latency_labels.items() if k in self.server_dict}
+            self.server_distance = geo.distances(self.server_dict, 
+                                                 geo.locate(self.config_dict.get("location", "")))
             self.serverListWidget.clear()
-            for key,val in sorted(self.server_dict.items(), key=lambda s: s[0].upper()):
+            #nearest servers first until latencies are known
+            for key,val in sorted(self.server_dict.items(), key=lambda s: self.sort_key(s[0])):
                 try:
                     val.pop("index")
                 except KeyError:
@@ -1441,8 +1608,9 @@ class QomuiGui(QtWidgets.QWidget):
 
     def add_server_widget(self, key, val, insert=None):
         setattr(self, key, ServerWidget())
-        self.ListItem = QtWidgets.QListWidgetItem()
+        self.ListItem = ServerItem()
         self.ListItem.setData(QtCore.Qt.UserRole, key)
+        self.ListItem.setData(ServerItem.SortRole, self.sort_key(key))
         self.ListItem.setSizeHint(QtCore.QSize(100, 50))
         if insert is None:
             self.serverListWidget.addItem(self.ListItem)
@@ -1468,6 +1636,8 @@ class QomuiGui(QtWidgets.QWidget):
         getattr(self, key).item_chosen_signal.connect(self.item_chosen_signal)
         getattr(self, key).set_hop_signal.connect(self.set_hop)
         getattr(self, key).changed_favourite_signal.connect(self.change_favourite)
+        if key in self.latency_labels:
+            getattr(self, key).display_latency(self.latency_labels[key])
 
     def pop_providerProtocolBox(self):
         self.providerProtocolBox.clear()
@@ -1607,6 +1777,10 @@ class QomuiGui(QtWidgets.QWidget):
                     random_list.append(key)
             except KeyError:
                 pass
+        #skip favourites that did not answer a single probe last time
+        reachable = [k for k in random_list if self.latency_values.get(k) != 999]
+        if len(reachable) != 0:
+            random_list = reachable
         if len(random_list) != 0:
             self.item_chosen_signal(random.choice(random_list), random="on")
         
@@ -1739,6 +1913,26 @@ class QomuiGui(QtWidgets.QWidget):
         self.ActiveWidget.disconnect.connect(self.kill)
         self.ActiveWidget.reconnect.connect(self.reconnect)
         #self.gridLayout.addWidget(self.ActiveWidget, 0, 0, 1, 3)
+        try:
+            if self.config_dict["bypass"] == 1:
+                self.bypass_stat_time = time.time()
+                try:
+                    self.bypassTimer.stop()
+                except AttributeError:
+                    self.bypassTimer = QtCore.QTimer(self)
+                    self.bypassTimer.timeout.connect(self.update_bypass_stats)
+                self.bypassTimer.start(2000)
+        except KeyError:
+            pass
+
+    def update_bypass_stats(self):
+        try:
+            stats = self.qomui_service.bypass_traffic()
+        except dbus.exceptions.DBusException:
+            return
+        now = time.time()
+        self.ActiveWidget.show_bypass_stats(stats, now - self.bypass_stat_time)
+        self.bypass_stat_time = now
         
     def reconnect(self):
         if self.status == "active":
@@ -1748,6 +1942,10 @@ class QomuiGui(QtWidgets.QWidget):
 
     def kill(self):
         self.status = "inactive"
+        try:
+            self.bypassTimer.stop()
+        except AttributeError:
+            pass
         self.WaitBar.setVisible(False)
         self.ActiveWidget.setVisible(False)
         try:
@@ -1818,27 +2016,24 @@ class QomuiGui(QtWidgets.QWidget):
             
     def bypass_tunnel(self, app):
         desktop_file = self.bypass_dict[app][1]
-        with open (desktop_file, "r") as cmd_ret:
-            search = cmd_ret.readlines()
-            found = 0
-            for line in search:
-                if line.startswith("Exec") and found !=1:
-                    cmd = line.split("=")[1].split(" ")[0].replace("\n", "")
-                    found = 1
-        
-        temp_bash = "%s/bypass_temp.sh" %HOMEDIR
-        with open (temp_bash, "w") as temp_sh:
-            lines = ["#!/bin/bash \n",
-                     "nohup cgexec -g net_cls:bypass_qomui %s & \n" %cmd,
-                     "#test"
-                     ]
-            temp_sh.writelines(lines)
-            temp_sh.close()
-            os.chmod(temp_bash, 0o774)
         try:
-            check_call([temp_bash])
-        except CalledProcessError:
-            logger.warning("Could not start %s" %app)
+            group = self.bypass_dict[app][2]
+        except IndexError:
+            group = bypass.default_group
+        attach = None
+        if bypass.cgroup_version() == 2:
+            attach = lambda pid: bool(self.qomui_service.bypass_pid(pid, group, app))
+        try:
+            spec = bypass.group_spec({"name" : group}, 0)
+            bypass.launch(bypass.parse_exec(desktop_file), cgroup=bypass.cgroup_dir(spec), attach=attach,
+                          failed=lambda name, code: self.bypass_failed.emit(app, code))
+            self.logger.info("Started %s in bypass mode" %app)
+        except (OSError, KeyError, ValueError, configparser.Error, 
+                SubprocessError, dbus.exceptions.DBusException) as e:
+            self.logger.warning("Could not start %s: %s" %(app, e))
+
+    def bypass_exited(self, app, code):
+        self.logger.warning("Could not start %s: exited with code %s" %(app, code))
         
     def modify_server(self):
         if self.serverListWidget.isVisible() is False:
@@ -1869,6 +2064,8 @@ class QomuiGui(QtWidgets.QWidget):
         rm = self.index_list.index(key)
         self.index_list.pop(rm)
         self.index_list.insert(rm, key_update)
+        if key in self.latency_values:
+            self.latency_values[key_update] = self.latency_values.pop(key)
         self.serverListWidget.takeItem(row)
         self.add_server_widget(key_update, val, insert=row)
         
@@ -1881,6 +2078,7 @@ class QomuiGui(QtWidgets.QWidget):
                 
         with open ("%s/server.json" % HOMEDIR, "w") as s:
             json.dump(self.server_dict, s) 
+        self.allow_servers()
         
         if len(new_config) != 0:
             if provider in SUPPORTED_PROVIDERS:
@@ -1907,6 +2105,13 @@ class QomuiGui(QtWidgets.QWidget):
             if self.serverListWidget.item(row).data(QtCore.Qt.UserRole) == key:
                 return row
         
+class ServerItem(QtWidgets.QListWidgetItem):
+    SortRole = QtCore.Qt.UserRole + 1
+
+    def __lt__(self, other):
+        return self.data(self.SortRole) < other.data(self.SortRole)
+
+
 class ServerWidget(QtWidgets.QWidget):
     item_chosen_signal = QtCore.pyqtSignal(str)
     set_hop_signal = QtCore.pyqtSignal(str)
@@ -2188,6 +2393,23 @@ class ActiveWidget(QtWidgets.QWidget):
                                             )
         self.horizontalLayout.addItem(spacerItem2)
         self.verticalLayout.addLayout(self.horizontalLayout)
+        self.horizontalLayout_5 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_5.setObjectName(_fromUtf8("horizontalLayout_5"))
+        self.bypassLabel = QtWidgets.QLabel(ConnectionWidget)
+        self.bypassLabel.setFont(bold_font)
+        self.bypassLabel.setObjectName(_fromUtf8("bypassLabel"))
+        self.bypassLabel.setVisible(False)
+        self.horizontalLayout_5.addWidget(self.bypassLabel)
+        self.bypassStatLabel = QtWidgets.QLabel(ConnectionWidget)
+        self.bypassStatLabel.setObjectName(_fromUtf8("bypassStatLabel"))
+        self.bypassStatLabel.setVisible(False)
+        self.horizontalLayout_5.addWidget(self.bypassStatLabel)
+        spacerItem3 = QtWidgets.QSpacerItem(40, 20, 
+                                            QtWidgets.QSizePolicy.Expanding, 
+                                            QtWidgets.QSizePolicy.Minimum
+                                            )
+        self.horizontalLayout_5.addItem(spacerItem3)
+        self.verticalLayout.addLayout(self.horizontalLayout_5)
         self.horizontalLayout_4 = QtWidgets.QHBoxLayout()
         self.horizontalLayout_4.setObjectName(_fromUtf8("horizontalLayout_4"))
         self.hopActiveLabel = QtWidgets.QLabel(ConnectionWidget)
@@ -2218,6 +2440,7 @@ class ActiveWidget(QtWidgets.QWidget):
         self.downloadLabel.setText(_translate("ConnectionWidget", "Download:", None))
         self.uploadLabel.setText(_translate("ConnectionWidget", "Upload:", None))
         self.timeLabel.setText(_translate("ConnectionWidget", "Time:", None))
+        self.bypassLabel.setText(_translate("ConnectionWidget", "Bypass:", None))
 
     def setText(self, server_dict, hop_dict, tun):
         self.tun = tun
@@ -2279,6 +2502,29 @@ class ActiveWidget(QtWidgets.QWidget):
         self.upStatLabel.setText("%s kB/s - %s mb" % (round(ULrate, 1), round(ULacc, 1)))
         self.downStatLabel.setText("%s kB/s - %s mb" % (round(DLrate, 1), round(DLacc, 1)))
 
+    def show_bypass_stats(self, stats, elapsed):
+        last = getattr(self, "bypass_last", None)
+        self.bypass_last = stats
+        self.bypassLabel.setVisible(True)
+        self.bypassStatLabel.setVisible(True)
+        lines = []
+        total = [0, 0, 0, 0]
+        for key in sorted(stats.keys()):
+            rx = stats[key].get("rx_bytes", 0)
+            tx = stats[key].get("tx_bytes", 0)
+            rates = [0.0, 0.0]
+            if last is not None and key in last and elapsed > 0:
+                rates = [(now - last[key].get(d, 0)) / elapsed / 1024.0 
+                         for now, d in ((rx, "rx_bytes"), (tx, "tx_bytes"))]
+            if "/" not in key:
+                total = [t + v for t, v in zip(total, [rates[0], rx, rates[1], tx])]
+            lines.append("%s: down %s mb - up %s mb" %(key, round(rx / (1024*1024), 1), 
+                                                       round(tx / (1024*1024), 1)))
+        self.bypassStatLabel.setText("Down: %s kB/s - %s mb  Up: %s kB/s - %s mb" % (
+                                     round(total[0], 1), round(total[1] / (1024*1024), 1),
+                                     round(total[2], 1), round(total[3] / (1024*1024), 1)))
+        self.bypassStatLabel.setToolTip("\n".join(lines))
+
     def signal(self):
         self.disconnect.emit()
         
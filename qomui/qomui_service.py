@@ -2,6 +2,7 @@
 
 from PyQt5 import QtCore
 import sys, os, time
+import errno
 import pexpect
 import re
 import shlex
@@ -19,7 +20,7 @@ import dbus
 import dbus.service
 from dbus.mainloop.pyqt5 import DBusQtMainLoop
 
-from qomui import firewall, bypass 
+from qomui import firewall, bypass, netlink 
 
 OPATH = "/org/qomui/service"
 IFACE = "org.qomui.service"
@@ -43,6 +44,7 @@ class QomuiDbus(dbus.service.Object):
     tun = "tun0"
     connect_status = 0
     config = {}
+    gui_uid = None
     
     def __init__(self):
         self.sys_bus = dbus.SystemBus()
@@ -102,13 +104,21 @@ class QomuiDbus(dbus.service.Object):
             with open('%s/default_config.json' % (ROOTDIR), 'r') as c:
                 self.config = json.load(c)
         try: 
-            firewall.apply_rules(self.config["firewall"])
+            firewall.apply_rules(self.config["firewall"], ping=self.config["ping"])
+            bypass.reload_rules()
             self.disable_ipv6(self.config["ipv6_disable"])
-            firewall.allow_ping(self.config["ping"])
             
         except KeyError:
             self.logger.warning('Could not read all values from config file')
             
+    @dbus.service.method(BUS_NAME, in_signature='', out_signature='a{sa{sd}}')
+    def firewall_timings(self):
+        return firewall.timings
+
+    @dbus.service.method(BUS_NAME, in_signature='', out_signature='aa{ss}')
+    def firewall_journal(self):
+        return firewall.get_journal()
+            
     @dbus.service.method(BUS_NAME, in_signature='i', out_signature='')
     def disable_ipv6(self, i):
         if i == 1:
@@ -153,33 +163,49 @@ class QomuiDbus(dbus.service.Object):
                 answer = check_output(dig_cmd).decode("utf-8")
                 parse = answer.split("\n")
                 ip = parse[len(parse)-2]
-                allow = firewall.add_rule(['-I', 'OUTPUT', '1', '-d', '%s' % (ip), '-j', 'ACCEPT'])
+                firewall.allow_ip(ip)
             except CalledProcessError as e:
                 self.logger.error("%s: Could not resolve %s" %(e, server))
 
+    @dbus.service.method(BUS_NAME, in_signature='as', out_signature='b', sender_keyword='sender')
+    def allow_servers(self, ips, sender=None):
+        #every local user may call the service - only root and the gui owner may open the kill switch
+        if self.owner_check(sender) is False:
+            self.logger.warning("Refused to update VPN server allowlist")
+            return False
+        return firewall.set_servers([str(ip) for ip in ips])
+
+    def owner_check(self, sender):
+        #the first unprivileged user to call an owner-only method owns the gui session
+        try:
+            uid = self.sys_bus.get_unix_user(sender)
+        except dbus.exceptions.DBusException:
+            return False
+        if uid == 0:
+            return True
+        elif self.gui_uid is None:
+            self.gui_uid = uid
+            self.logger.debug("Dbus: uid %s registered as gui owner" %uid)
+        return uid == self.gui_uid
+
     def allow_dns(self):
         self.logger.debug("iptables: temporarily allowing DNS requests")
-        ipt_dns_out_add = firewall.add_rule(['-I', 'OUTPUT','1', '-p', 'udp',
-                                 '-d', self.config["alt_dns1"], '--dport', '53','-j', 'ACCEPT'])
-        ipt_dns_in_add = firewall.add_rule(['-I', 'INPUT','2', '-p', 'udp',
-                                '-s', self.config["alt_dns1"], '--sport', '53','-j', 'ACCEPT'])
-        ipt_dns_out_add_alt = firewall.add_rule(['-I', 'OUTPUT','3', '-p', 'udp',
-                                     '-d', self.config["alt_dns2"], '--dport', '53','-j', 'ACCEPT'])
-        ipt_dns_in_add_alt = firewall.add_rule(['-I', 'INPUT','4', '-p', 'udp',
-                                    '-s', self.config["alt_dns2"], '--sport', '53','-j', 'ACCEPT'])
+        for rule in self.dns_rules():
+            firewall.add_rule(['-A'] + rule)
         self.update_dns()
     
     @dbus.service.method(BUS_NAME, in_signature='', out_signature='')
     def block_dns(self):
         self.logger.debug("iptables: deleting exception for DNS requests")
-        ipt_dns_out_del = firewall.add_rule(['-D', 'OUTPUT','-p', 'udp',
-                                 '-d', self.config["alt_dns1"], '--dport', '53','-j', 'ACCEPT'])
-        ipt_dns_in_del = firewall.add_rule(['-D', 'INPUT','-p', 'udp',
-                                '-s', self.config["alt_dns1"], '--sport', '53','-j', 'ACCEPT'])
-        ipt_dns_out_del_alt = firewall.add_rule(['-D', 'OUTPUT','-p', 'udp',
-                                     '-d', self.config["alt_dns2"], '--dport', '53','-j', 'ACCEPT'])
-        ipt_dns_in_del_alt = firewall.add_rule(['-D', 'INPUT','-p', 'udp',
-                                    '-s', self.config["alt_dns2"], '--sport', '53','-j', 'ACCEPT']) 
+        for rule in self.dns_rules():
+            firewall.add_rule(['-D'] + rule)
+            
+    def dns_rules(self):
+        rules = []
+        for dns in [self.config["alt_dns1"], self.config["alt_dns2"]]:
+            rules.append([firewall.allow_chain, '-p', 'udp', '-d', dns, '--dport', '53', '-j', 'ACCEPT'])
+            rules.append([firewall.allow_chain, '-p', 'udp', '-s', dns, '--sport', '53', '-j', 'ACCEPT'])
+        return rules
         
     @dbus.service.method(BUS_NAME, in_signature='', out_signature='')
     def save_default_dns(self):
@@ -294,19 +320,13 @@ class QomuiDbus(dbus.service.Object):
         
     @dbus.service.method(BUS_NAME, in_signature='a{ss}', out_signature='')
     def bypass(self, ug):
-        try:
-            self.kill_pid(self.dnsmasq_pid)
-        except AttributeError:
-            pass
-        
         default_gateway = self.default_gateway_check()["gateway"]
         if default_gateway != "None":
             try:
                 if self.config["bypass"] == 1:
-                    pid = bypass.create_cgroup(ug["user"], ug["group"], 
-                                               self.default_interface, default_gateway
-                                               )
-                    self.dnsmasq_pid = (pid, "dnsmasq")
+                    bypass.create_cgroup(ug["user"], ug["group"], 
+                                         self.default_interface, default_gateway
+                                         )
                 elif self.config["bypass"] == 0:
                     try:
                         bypass.delete_cgroup(self.default_interface)
@@ -314,20 +334,41 @@ class QomuiDbus(dbus.service.Object):
                         pass
             except KeyError:
                 self.logger.warning('Could not read all values from  file')
+
+    @dbus.service.method(BUS_NAME, in_signature='iss', out_signature='b', sender_keyword='sender')
+    def bypass_pid(self, pid, group, app, sender=None):
+        try:
+            uid = self.sys_bus.get_unix_user(sender)
+            if uid != 0 and psutil.Process(pid).uids().real != uid:
+                self.logger.warning("Refused to move process %s into bypass cgroup" %pid)
+                return False
+            bypass.attach_pid(pid, name=group, app=app)
+            return True
+        except (OSError, KeyError, psutil.Error, dbus.exceptions.DBusException) as e:
+            self.logger.error("Could not move process %s into bypass cgroup: %s" %(pid, e))
+            return False
+
+    @dbus.service.method(BUS_NAME, in_signature='', out_signature='a{sa{st}}')
+    def bypass_traffic(self):
+        return bypass.traffic()
+
+    def update_bypass_route(self):
+        if len(bypass.groups) != 0:
+            route = self.default_gateway_check()
+            if route["gateway"] != "None":
+                bypass.update_gateway(route["interface"], route["gateway"])
     
     @dbus.service.method(BUS_NAME, in_signature='', out_signature='a{ss}')
     def default_gateway_check(self):
         try:
-            route_cmd = ["ip", "route", "show", "default", "0.0.0.0/0"]
-            default_route = check_output(route_cmd).decode("utf-8")
-            parse_route = default_route.split(" ")
-            self.default_interface = parse_route[4]
-            default_gateway = parse_route[2]
-            default_interface = parse_route[4]
-            return {"gateway" : default_gateway, "interface" : default_interface}
-        except (CalledProcessError, IndexError):
+            default_route = netlink.default_route()
+        except OSError:
+            default_route = None
+        if default_route is None:
             self.logger.info('Could not identify default gateway - no network connectivity')
             return {"gateway" : "None", "interface" : "None"}
+        self.default_interface = default_route["interface"]
+        return default_route
         
     @dbus.service.signal(BUS_NAME, signature='s')
     def reply(self, msg):
@@ -366,9 +407,10 @@ class QomuiDbus(dbus.service.Object):
             
     def vpn_thread(self):
         self.connect_status = 0
+        self.update_bypass_route()
         provider = self.ovpn_dict["provider"]
         ip = self.ovpn_dict["ip"]
-        firewall.add_rule(['-I', 'OUTPUT', '1', '-d', '%s' %ip, '-j', 'ACCEPT'])
+        firewall.allow_ip(ip)
         self.logger.info("iptables: created rule for %s" %ip)
         path = "%s/temp.ovpn" %ROOTDIR
         cwd_ovpn = None
@@ -421,9 +463,7 @@ class QomuiDbus(dbus.service.Object):
             cwd_ovpn=os.path.dirname(config_file) 
             
         if self.hop == "2":
-            firewall_hop_add = firewall.add_rule(['-I', 'OUTPUT', '1', '-d', 
-                                                  '%s' % (self.hop_dict["ip"]), '-j', 'ACCEPT']
-                                                )
+            firewall.allow_ip(self.hop_dict["ip"])
             
             if self.hop_dict["provider"] in SUPPORTED_PROVIDERS:
                 hop_path = "%s/hop.ovpn" %ROOTDIR
@@ -488,27 +528,22 @@ class QomuiDbus(dbus.service.Object):
         logging.info("Establishing new OpenVPN tunnel")
         name = self.ovpn_dict["name"]
         last_ip = self.ovpn_dict["ip"]
+        tun = None
         if h == "1":
             name = self.hop_dict["name"]
             self.logger.info("Establishing connection to %s - first hop" %name)
             last_ip = self.hop_dict["ip"]
+            self.pre_gateway = self.default_gateway_check()["gateway"]
             cmd_ovpn = ['openvpn',
                         '--config', '%s' %(ovpn_file), 
-                        '--route-nopull', 
-                        '--script-security', '2', 
-                        '--up', '/usr/share/qomui/hop.sh -f %s %s' %(self.hop_dict["ip"], 
-                                                                     self.ovpn_dict["ip"]
-                                                                     ),
-                        '--down', '/usr/share/qomui/hop_down.sh %s' %(self.hop_dict["ip"])
+                        '--route-nopull'
                         ]
             
         elif h == "2":
             self.logger.info("Establishing connection to %s - second hop" %name)
             cmd_ovpn = ['openvpn',
                         '--config', '%s' %(ovpn_file), 
-                        '--route-nopull', 
-                        '--script-security', '2', 
-                        '--up', '%s/hop.sh -s' %(ROOTDIR)
+                        '--route-nopull'
                         ]
             
         else:
@@ -525,6 +560,8 @@ class QomuiDbus(dbus.service.Object):
                 line_format = ("OpenVPN:" + line.replace('%s' %(time.asctime()), '').replace('\n', ''))
                 logging.info(line_format)
                 if line.find("Initialization Sequence Completed") != -1:
+                    if h in ("1", "2"):
+                        self.hop_routes(h, tun)
                     self.connect_status = 1
                     self.reply("success")
                     self.logger.info("Successfully connected to %s" %name)
@@ -532,6 +569,7 @@ class QomuiDbus(dbus.service.Object):
                         self.update_dns()
                 elif line.find('TUN/TAP device') != -1:
                     self.tun = line_format.split(" ")[3]
+                    tun = self.tun
                 elif line.find('PUSH: Received control message:') != -1:
                     dns_option_1 = line_format.find('dhcp-option')
                     if dns_option_1 != -1:
@@ -559,8 +597,28 @@ class QomuiDbus(dbus.service.Object):
         ovpn_exe.stdout.close()
         self.reply("kill")
         self.logger.info("OpenVPN - process killed")
-        firewall_del = firewall.add_rule(['-D', 'OUTPUT',
-                                  '-d', '%s' % (last_ip), '-j', 'ACCEPT'])
+        firewall.block_ip(last_ip)
+        if h == "1":
+            try:
+                netlink.transact([netlink.route_msg("del", self.hop_dict["ip"])], 
+                                 ignore=(errno.ESRCH,))
+            except (OSError, ValueError) as e:
+                self.logger.debug("Could not remove route to %s: %s" %(self.hop_dict["ip"], e))
+
+    def hop_routes(self, h, tun):
+        if h == "1":
+            routes = [netlink.route_msg("add", self.hop_dict["ip"], gateway=self.pre_gateway),
+                      netlink.route_msg("add", self.ovpn_dict["ip"], dev=tun)
+                      ]
+        else:
+            routes = [netlink.route_msg("add", "0.0.0.0/1", dev=tun),
+                      netlink.route_msg("add", "128.0.0.0/1", dev=tun)
+                      ]
+        try:
+            netlink.transact(routes)
+            self.logger.debug("Added routes for double-hop via %s" %tun)
+        except (OSError, ValueError, TypeError) as e:
+            self.logger.error("Failed to set up routes for double-hop: %s" %e)
 
     def ssl(self, ip):
         cmd_ssl = ['stunnel','%s' % ("%s/temp.ssl" % (ROOTDIR))]
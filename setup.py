@@ -17,9 +17,7 @@ data_files = [
                           'resources/firewall_default.json',
                           'resources/Mullvad_config',
                           'resources/ssl_config',
-                          'resources/qomui.png',
-                          'resources/hop.sh',
-                          'resources/hop_down.sh']),
+                          'resources/qomui.png']),
         ('/usr/share/qomui/flags/', glob.glob('resources/flags/*'))
         ]
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import threading
+from qomui import bypass
+
+def write_desktop(path, exec_line):
+    path.write_text("[Desktop Entry]\nName=My App\nIcon=myapp\nExec=%s\n" %exec_line)
+    return str(path)
+
+def test_parse_exec_field_codes(tmp_path):
+    desktop_file = write_desktop(tmp_path / "app.desktop", "myapp --title=%c %i %f %U --rate=50%%")
+    assert bypass.parse_exec(desktop_file) == ["myapp", "--title=My App", "--icon", "myapp", "--rate=50%"]
+
+def test_parse_exec_cache_follows_mtime(tmp_path):
+    path = tmp_path / "app.desktop"
+    desktop_file = write_desktop(path, "first")
+    assert bypass.parse_exec(desktop_file) == ["first"]
+    write_desktop(path, "second %F")
+    os.utime(desktop_file, ns=(0, os.stat(desktop_file).st_mtime_ns + 10**9))
+    assert bypass.parse_exec(desktop_file) == ["second"]
+
+def wait_for(path):
+    for _ in range(100):
+        if path.exists():
+            return True
+        time.sleep(0.05)
+    return False
+
+def test_launch_with_high_fds(tmp_path):
+    #the gui always has plenty of fds open, so the handshake pipe lands above 9
+    spare = [os.open(os.devnull, os.O_RDONLY) for _ in range(12)]
+    try:
+        marker = tmp_path / "started"
+        failed = []
+        pid = bypass.launch(["touch", str(marker)], cgroup=str(tmp_path),
+                            failed=lambda name, code: failed.append(code))
+        assert wait_for(marker)
+        assert (tmp_path / "cgroup.procs").read_text() == str(pid)
+        time.sleep(bypass.launch_check)
+        assert failed == []
+    finally:
+        for fd in spare:
+            os.close(fd)
+
+def test_launch_reports_early_exit(tmp_path):
+    done = threading.Event()
+    failed = []
+
+    def report(name, code):
+        failed.append((name, code))
+        done.set()
+
+    bypass.launch([str(tmp_path / "missing")], cgroup=str(tmp_path), failed=report)
+    assert done.wait(5)
+    assert failed == [(str(tmp_path / "missing"), 127)]
+
+def test_launch_refused_attach(tmp_path):
+    marker = tmp_path / "started"
+    try:
+        bypass.launch(["touch", str(marker)], cgroup=str(tmp_path), attach=lambda pid: False)
+    except OSError:
+        pass
+    else:
+        assert False, "launch should fail when the pid cannot be moved"
+    assert not marker.exists()
+
+def test_nft_reload_keeps_rules_in_ruleset(monkeypatch):
+    monkeypatch.setattr(bypass.firewall, "backend", "nftables")
+    monkeypatch.setattr(bypass, "cgroup_version", lambda: 1)
+    monkeypatch.setattr(bypass.nft, "runtime_rules", {})
+    monkeypatch.setattr(bypass.nft, "list_chain", lambda chain: "")
+    payloads = []
+    monkeypatch.setattr(bypass.nft, "run_nft", lambda payload: payloads.append(payload) or True)
+    spec = bypass.group_spec({"name" : "default"}, 0)
+    monkeypatch.setattr(bypass, "groups", {"default" : {"spec" : spec, "interface" : "eth0", "apps" : set()}})
+    bypass.firewall.add_rules(bypass.cgroup_rules(spec, "eth0"))
+
+    #the profile and the group rules go into one transaction
+    ruleset = bypass.nft.render_ruleset([["-P", "OUTPUT", "DROP"]], [])
+    assert "meta cgroup 0x00110011 meta mark set 11" in ruleset
+    assert 'oifname "eth0" masquerade' in ruleset
+    del payloads[:]
+    bypass.reload_rules()
+    assert payloads == []
+
+def test_remove_group_keeps_shared_rp_filter(monkeypatch):
+    calls = []
+    monkeypatch.setattr(bypass, "set_rp_filter", lambda interface, value: calls.append((interface, value)))
+    monkeypatch.setattr(bypass.netlink, "transact", lambda msgs, ignore=(): None)
+    monkeypatch.setattr(bypass.firewall, "add_rules", lambda rules: True)
+    monkeypatch.setattr(bypass, "cgroup_version", lambda: 1)
+    groups = {}
+    for index, name in enumerate(("first", "second")):
+        groups[name] = {"spec" : bypass.group_spec({"name" : name}, index), "interface" : "eth0",
+                        "apps" : set(), "resolver" : None}
+    monkeypatch.setattr(bypass, "groups", groups)
+    bypass.remove_group("first")
+    assert calls == []
+    bypass.remove_group("second")
+    assert calls == [("eth0", "1")]
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import struct
+import pytest
+from qomui import dnscache
+
+def answer(query, rcode=0, records=(), authority=()):
+    #response to a query built by build_query: question copied, opt record dropped
+    qid = struct.unpack_from("!H", query)[0]
+    question = query[dnscache.header.size:-11]
+    body = b""
+    for rtype, ttl, rdata in list(records) + list(authority):
+        body += b"\xc0\x0c" + dnscache.rr_fixed.pack(rtype, 1, ttl, len(rdata)) + rdata
+    return (dnscache.header.pack(qid, 0x8180 | rcode, 1, len(records), len(authority), 0) +
+            question + body)
+
+def test_build_and_parse_query():
+    query = dnscache.build_query("Example.COM", 1)
+    qid, key, edns = dnscache.parse_query(query)
+    assert qid == struct.unpack_from("!H", query)[0]
+    assert key == ("example.com", 1, 1)
+    assert edns is True
+
+def test_parse_query_rejects_responses():
+    query = dnscache.build_query("example.com", 1)
+    with pytest.raises(ValueError):
+        dnscache.parse_query(answer(query))
+
+def test_read_name_compression():
+    msg = b"\x07example\x03com\x00" + b"\x03www\xc0\x00"
+    assert dnscache.read_name(msg, 13) == "www.example.com"
+    assert dnscache.skip_name(msg, 13) == len(msg)
+
+def test_read_name_loop():
+    with pytest.raises(ValueError):
+        dnscache.read_name(b"\xc0\x00", 0)
+
+def test_parse_response_ttls():
+    query = dnscache.build_query("example.com", 1)
+    msg = answer(query, records=[(1, 300, b"\x01\x02\x03\x04"), (1, 60, b"\x05\x06\x07\x08")])
+    ttls, negative, soa_min, rcode = dnscache.parse_response(msg)
+    assert [ttl for offset, ttl in ttls] == [300, 60]
+    for offset, ttl in ttls:
+        assert struct.unpack_from("!I", msg, offset)[0] == ttl
+    assert (negative, soa_min, rcode) == (False, None, 0)
+
+def test_parse_response_negative_soa():
+    query = dnscache.build_query("missing.example.com", 1)
+    soa = b"\0\0" + struct.pack("!IIIII", 1, 7200, 900, 1209600, 30)
+    msg = answer(query, rcode=3, authority=[(6, 120, soa)])
+    ttls, negative, soa_min, rcode = dnscache.parse_response(msg)
+    assert (negative, soa_min, rcode) == (True, 30, 3)
+
+def test_forwarder_cache_rewrites_id_and_ttl(monkeypatch):
+    forwarder = dnscache.Forwarder(0)
+    query = dnscache.build_query("example.com", 1)
+    response = answer(query, records=[(1, 300, b"\x01\x02\x03\x04")])
+    monkeypatch.setattr(forwarder, "forward", lambda q, tcp=False: response)
+    assert forwarder.resolve(query) == response
+
+    clock = [1000.0]
+    monkeypatch.setattr(dnscache.time, "time", lambda: clock[0])
+    forwarder.cache.clear()
+    forwarder.resolve(query)
+    clock[0] += 100
+    second = dnscache.build_query("example.com", 1)
+    cached = forwarder.resolve(second)
+    assert cached[:2] == second[:2]
+    offset = dnscache.parse_response(cached)[0][0][0]
+    assert struct.unpack_from("!I", cached, offset)[0] == 200
+    assert forwarder.stats["hits"] == 1
+
+def test_forward_rejects_other_question(monkeypatch):
+    forwarder = dnscache.Forwarder(0)
+    query = dnscache.build_query("example.com", 1)
+    other = dnscache.build_query("attacker.example", 1)
+    monkeypatch.setattr(dnscache, "get_nameservers", lambda: ["192.0.2.1"])
+    monkeypatch.setattr(forwarder, "forward_udp", lambda request, server, upstream_id:
+                        request[:2] + answer(other, records=[(1, 300, b"\x01\x02\x03\x04")])[2:])
+    assert forwarder.forward(query) is None
+
+    monkeypatch.setattr(forwarder, "forward_udp", lambda request, server, upstream_id:
+                        answer(request, records=[(1, 300, b"\x01\x02\x03\x04")]))
+    assert forwarder.forward(query)[:2] == query[:2]
+
+def test_save_history_private(tmp_path):
+    history = tmp_path / "bypass_dns_default.json"
+    history.write_text("[]")
+    history.chmod(0o644)
+    forwarder = dnscache.Forwarder(0, history=str(history))
+    forwarder.recent[("example.com", 1)] = 0
+    forwarder.save_history()
+    assert history.stat().st_mode & 0o777 == 0o600
+    assert forwarder.load_history() == [("example.com", 1)]
+    assert [p.name for p in tmp_path.iterdir()] == [history.name]
+
+def test_alive_needs_serve_threads():
+    forwarder = dnscache.Forwarder(0)
+    forwarder.start()
+    try:
+        assert forwarder.alive() is True
+        dead = dnscache.threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        forwarder.threads[0] = dead
+        assert forwarder.alive() is False
+    finally:
+        forwarder.stop()
+
+def test_start_releases_port_on_failure():
+    with dnscache.socket.socket(dnscache.socket.AF_INET, dnscache.socket.SOCK_STREAM) as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen(1)
+        port = taken.getsockname()[1]
+        forwarder = dnscache.Forwarder(port)
+        with pytest.raises(OSError):
+            forwarder.start()
+        assert forwarder.sockets == []
+        assert forwarder.udp.fileno() == -1
+        #the udp port is free again
+        with dnscache.socket.socket(dnscache.socket.AF_INET, dnscache.socket.SOCK_DGRAM) as udp:
+            udp.bind(("127.0.0.1", port))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+from qomui import firewall
+
+saved = """# Generated by iptables-save
+*filter
+:INPUT DROP [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT DROP [0:0]
+:QOMUI-OUT - [0:0]
+-A INPUT -i lo -j ACCEPT
+-A OUTPUT -d 10.0.0.1/32 -m comment --comment "qomui test" -j ACCEPT
+COMMIT
+"""
+
+def test_parse_save():
+    model = firewall.parse_save(saved)
+    filter_table = model["filter"]
+    assert filter_table["policies"] == {"INPUT" : "DROP", "FORWARD" : "DROP", "OUTPUT" : "DROP"}
+    assert filter_table["chains"]["QOMUI-OUT"] == []
+    assert filter_table["chains"]["INPUT"] == [("-i", "lo", "-j", "ACCEPT")]
+    assert filter_table["chains"]["OUTPUT"] == [("-d", "10.0.0.1/32", "-m", "comment",
+                                                 "--comment", "qomui test", "-j", "ACCEPT")]
+
+def test_rule_key_ignores_host_prefix():
+    assert firewall.rule_key(["-d", "10.0.0.1/32", "-j", "ACCEPT"]) == firewall.rule_key(["-j", "ACCEPT", "-d", "10.0.0.1"])
+
+def test_diff_chain_unchanged():
+    rules = [("-i", "lo", "-j", "ACCEPT"), ("-o", "lo", "-j", "ACCEPT")]
+    assert firewall.diff_chain("filter", "INPUT", rules, list(rules)) == []
+
+def test_diff_chain_insert_and_delete():
+    live = [("-i", "lo", "-j", "ACCEPT"), ("-i", "eth0", "-j", "DROP")]
+    desired = [("-i", "lo", "-j", "ACCEPT"), ("-i", "tun0", "-j", "ACCEPT")]
+    assert firewall.diff_chain("filter", "INPUT", live, desired) == [
+        ["-t", "filter", "-D", "INPUT", "2"],
+        ["-t", "filter", "-I", "INPUT", "2", "-i", "tun0", "-j", "ACCEPT"]
+        ]
+
+def test_diff_chain_reorder_rewrites_chain():
+    a = ("-i", "lo", "-j", "ACCEPT")
+    b = ("-i", "tun0", "-j", "ACCEPT")
+    assert firewall.diff_chain("filter", "INPUT", [a, b], [b, a]) == [
+        ["-t", "filter", "-F", "INPUT"],
+        ["-t", "filter", "-A", "INPUT"] + list(b),
+        ["-t", "filter", "-A", "INPUT"] + list(a)
+        ]
+
+def test_reconcile():
+    live = firewall.parse_save(saved)
+    rules = [["-P", "OUTPUT", "ACCEPT"],
+             ["-N", "QOMUI-IN"],
+             ["-A", "INPUT", "-i", "tun0", "-j", "ACCEPT"],
+             ["-X", "QOMUI-OUT"]
+             ]
+    assert firewall.reconcile(live, rules) == [
+        ["-t", "filter", "-P", "OUTPUT", "ACCEPT"],
+        ["-t", "filter", "-N", "QOMUI-IN"],
+        ["-t", "filter", "-I", "INPUT", "2", "-i", "tun0", "-j", "ACCEPT"],
+        ["-t", "filter", "-X", "QOMUI-OUT"]
+        ]
+
+def test_reconcile_no_changes():
+    live = firewall.parse_save(saved)
+    assert firewall.reconcile(live, [["-A", "INPUT", "-i", "lo", "-j", "ACCEPT"], ["-D", "INPUT", "-i", "lo", "-j", "ACCEPT"]]) == []
+
+def test_reconcile_drops_duplicate_rules():
+    lo = ["-i", "lo", "-j", "ACCEPT"]
+    live = firewall.parse_save("*filter\n:INPUT DROP [0:0]\n"
+                               "-A INPUT -i lo -j ACCEPT\n-A INPUT -i lo -j ACCEPT\nCOMMIT\n")
+    assert firewall.reconcile(live, [["-F", "INPUT"], ["-A", "INPUT"] + lo]) == [
+        ["-t", "filter", "-D", "INPUT", "2"]
+        ]
+    live = firewall.parse_save("*filter\n:INPUT DROP [0:0]\nCOMMIT\n")
+    assert firewall.reconcile(live, [["-A", "INPUT"] + lo, ["-A", "INPUT", "-i", "lo", "-j", "ACCEPT"]]) == [
+        ["-t", "filter", "-I", "INPUT", "1"] + lo
+        ]
+
+def test_rule_key_keeps_directions_apart():
+    assert firewall.rule_key(["-s", "10.0.0.1", "-d", "10.0.0.2", "-j", "ACCEPT"]) != \
+        firewall.rule_key(["-s", "10.0.0.2/32", "-d", "10.0.0.1/32", "-j", "ACCEPT"])
+    assert firewall.rule_key(["-i", "tun0", "-o", "eth0", "-j", "ACCEPT"]) != \
+        firewall.rule_key(["-i", "eth0", "-o", "tun0", "-j", "ACCEPT"])
+
+def test_rule_key_host_suffix():
+    assert firewall.rule_key(["-d", "fd00::1/128", "-j", "ACCEPT"]) == firewall.rule_key(["-d", "fd00::1", "-j", "ACCEPT"])
+    #a /32 ipv6 prefix is not a host address
+    assert firewall.rule_key(["-d", "2001:db8::/32", "-j", "ACCEPT"]) != firewall.rule_key(["-d", "2001:db8::", "-j", "ACCEPT"])
+
+def test_rule_key_implicit_matches():
+    assert firewall.rule_key(["-p", "icmp", "--icmp-type", "echo-request", "-j", "ACCEPT"]) == \
+        firewall.rule_key(["-p", "icmp", "-m", "icmp", "--icmp-type", "8", "-j", "ACCEPT"])
+    assert firewall.rule_key(["-p", "icmpv6", "--icmpv6-type", "echo-reply", "-j", "ACCEPT"]) == \
+        firewall.rule_key(["-p", "ipv6-icmp", "-m", "icmp6", "--icmpv6-type", "129", "-j", "ACCEPT"])
+    assert firewall.rule_key(["-o", "eth0", "-p", "udp", "--dport", "53", "-j", "ACCEPT"]) == \
+        firewall.rule_key(["-p", "udp", "-o", "eth0", "-m", "udp", "--dport", "53", "-j", "ACCEPT"])
+    assert firewall.rule_key(["-m", "state", "--state", "RELATED,ESTABLISHED", "-j", "ACCEPT"]) == \
+        firewall.rule_key(["-m", "conntrack", "--ctstate", "ESTABLISHED,RELATED", "-j", "ACCEPT"])
+
+def test_reconcile_replaces_swapped_rule():
+    live = firewall.parse_save("*filter\n:QOMUI-ALLOW - [0:0]\n"
+                               "-A QOMUI-ALLOW -s 10.0.0.2/32 -d 10.0.0.1/32 -j ACCEPT\nCOMMIT\n")
+    rules = [["-F", "QOMUI-ALLOW"], ["-A", "QOMUI-ALLOW", "-s", "10.0.0.1", "-d", "10.0.0.2", "-j", "ACCEPT"]]
+    assert firewall.reconcile(live, rules) == [
+        ["-t", "filter", "-D", "QOMUI-ALLOW", "1"],
+        ["-t", "filter", "-I", "QOMUI-ALLOW", "1", "-s", "10.0.0.1", "-d", "10.0.0.2", "-j", "ACCEPT"]
+        ]
+
+def test_reconcile_allowping_is_stable():
+    #as iptables-save prints the allowping rules
+    live = firewall.parse_save("*filter\n:INPUT DROP [0:0]\n:OUTPUT DROP [0:0]\n"
+                               "-A INPUT -p icmp -m icmp --icmp-type 0 -j ACCEPT\n"
+                               "-A OUTPUT -p icmp -m icmp --icmp-type 8 -j ACCEPT\nCOMMIT\n")
+    rules = [["-F", "INPUT"], ["-F", "OUTPUT"],
+             ["-I", "OUTPUT", "1", "-p", "icmp", "--icmp-type", "echo-request", "-j", "ACCEPT"],
+             ["-I", "INPUT", "1", "-p", "icmp", "--icmp-type", "echo-reply", "-j", "ACCEPT"]
+             ]
+    assert firewall.reconcile(live, rules) == []
+
+def test_rule_key_bypass_targets():
+    #as iptables-save prints the bypass mark and cgroup rules
+    assert firewall.rule_key(["-m", "cgroup", "--cgroup", "0x00110011", "-j", "MARK", "--set-mark", "11"]) == \
+        firewall.rule_key(["-m", "cgroup", "--cgroup", "1114129", "-j", "MARK", "--set-xmark", "0xb/0xffffffff"])
+
+def test_pending_rules():
+    live = firewall.parse_save("*mangle\n:OUTPUT ACCEPT [0:0]\n"
+                               "-A OUTPUT -m cgroup --cgroup 1114129 -j MARK --set-xmark 0xb/0xffffffff\n"
+                               "COMMIT\n")
+    mark = ["-t", "mangle", "-A", "OUTPUT", "-m", "cgroup", "--cgroup", "0x00110011",
+            "-j", "MARK", "--set-mark", "11"]
+    nat = ["-t", "nat", "-A", "POSTROUTING", "-o", "eth0", "-j", "MASQUERADE"]
+    old_nat = ["-t", "nat", "-D", "POSTROUTING", "-o", "wlan0", "-j", "MASQUERADE"]
+    allow = ["-A", "QOMUI-ALLOW", "-d", "10.0.0.1", "-j", "ACCEPT"]
+    assert firewall.pending_rules(live, [mark, nat, nat, old_nat, ["-N", "QOMUI-ALLOW"], allow]) == \
+        [nat, ["-N", "QOMUI-ALLOW"], allow]
+    assert firewall.pending_rules(live, [mark[:2] + ["-D"] + mark[3:]]) == [mark[:2] + ["-D"] + mark[3:]]
+
+def test_set_servers_ipset(monkeypatch):
+    payloads = []
+    monkeypatch.setattr(firewall, "backend", "iptables")
+    monkeypatch.setattr(firewall, "listed_servers", set())
+    monkeypatch.setattr(firewall, "run_ipset", lambda payload: payloads.append(payload) or True)
+    ips = ["10.0.0.2", "10.0.0.1", "10.0.0.1", "fd00::0001", "", "0.0.0.0", "vpn.example.com", "10.0.0.256"]
+    assert firewall.set_servers(ips) is True
+    lines = payloads[0].split("\n")
+    assert [l for l in lines if l.startswith("add ")] == ["add qomui_servers_tmp 10.0.0.1 -exist",
+                                                          "add qomui_servers_tmp 10.0.0.2 -exist",
+                                                          "add qomui_servers6_tmp fd00::1 -exist"]
+    assert "swap qomui_servers_tmp qomui_servers" in lines
+    assert firewall.listed_servers == {"10.0.0.1", "10.0.0.2", "fd00::1"}
+
+def test_set_servers_nft(monkeypatch):
+    calls = []
+    monkeypatch.setattr(firewall, "backend", "nftables")
+    monkeypatch.setattr(firewall, "listed_servers", set())
+    monkeypatch.setattr(firewall.nft, "set_servers", lambda v4, v6: calls.append((v4, v6)) or False)
+    assert firewall.set_servers(["10.0.0.1", "fd00::1", "bogus"]) is False
+    assert calls == [(["10.0.0.1"], ["fd00::1"])]
+    #a failed update keeps the old allowlist
+    assert firewall.listed_servers == set()
+
+def config(**extra):
+    raw = {key : [["-A", "OUTPUT", "-j", "ACCEPT"], []] for key in firewall.rule_lists}
+    raw.update(extra)
+    return raw
+
+def test_validate_config():
+    validated = firewall.validate_config(config(backend="nftables", preserve_rules=1))
+    assert validated["ipv4rules"] == (("-A", "OUTPUT", "-j", "ACCEPT"),)
+    assert validated["backend"] == "nftables"
+    assert validated["preserve_rules"] == 1
+
+def test_validate_config_rejects_malformed():
+    for raw in (config(backend="pf"),
+                config(ipv4rules=["-A OUTPUT -j ACCEPT"]),
+                config(ipv4rules=[["-A", "OUTPUT", 1]]),
+                {k : v for k, v in config().items() if k != "allowping"}):
+        try:
+            firewall.validate_config(raw)
+        except ValueError:
+            continue
+        assert False, "accepted %s" %raw
+
+def test_load_config_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(firewall, "config_cache", {})
+    path = tmp_path / "firewall.json"
+    path.write_text(json.dumps(config()))
+    first = firewall.load_config(str(path))
+    assert firewall.load_config(str(path)) is first
+
+    path.write_text(json.dumps(config(backend="nftables")))
+    os.utime(str(path), ns=(0, os.stat(str(path)).st_mtime_ns + 10**9))
+    assert firewall.load_config(str(path))["backend"] == "nftables"
+
+    path.write_text("{")
+    os.utime(str(path), ns=(0, os.stat(str(path)).st_mtime_ns + 10**9))
+    assert firewall.load_config(str(path)) is None
+    assert firewall.load_config(str(tmp_path / "missing.json")) is None
+
+def profile():
+    raw = config(defaults=[["-P", "INPUT", "DROP"], ["-P", "OUTPUT", "DROP"], ["-P", "FORWARD", "DROP"]],
+                 unsecure=[["-P", "INPUT", "ACCEPT"], ["-P", "OUTPUT", "ACCEPT"], ["-P", "FORWARD", "ACCEPT"]],
+                 allowping=[["-I", "OUTPUT", "1", "-p", "icmp", "--icmp-type", "echo-request", "-j", "ACCEPT"]])
+    raw["defaultsv6"] = raw["defaults"]
+    raw["unsecurev6"] = raw["unsecure"]
+    return raw
+
+def test_load_config_precompiles_states(tmp_path, monkeypatch):
+    monkeypatch.setattr(firewall, "config_cache", {})
+    path = tmp_path / "firewall.json"
+    path.write_text(json.dumps(profile()))
+    loaded = firewall.load_config(str(path))
+    states = firewall.precompiled(loaded)
+    assert states[("ipv4", 1, 0, None)]["jump"] is True
+    assert states[("ipv4", None, 0, None)]["remove"] is True
+    #a rule outside the chains qomui owns cannot be precompiled
+    assert firewall.compile_state([["-t", "nat", "-A", "POSTROUTING", "-j", "MASQUERADE"]]) is None
+    lo = ["-A", "QOMUI-IN", "-i", "lo", "-j", "ACCEPT"]
+    assert firewall.compile_state([["-N", "QOMUI-IN"], lo, lo])["lines"] == ["-A QOMUI-IN -i lo -j ACCEPT"]
+
+def test_state_payload_secure():
+    state = firewall.compile_state(firewall.chain_rules(firewall.validate_config(profile()), 1))
+    live = firewall.parse_save("*filter\n:INPUT ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\n"
+                               "-A INPUT -j QOMUI-IN\n-A INPUT -j QOMUI-IN\n-A OUTPUT -j QOMUI-OUT\n"
+                               "-A OUTPUT -j OTHER\nCOMMIT\n")
+    lines = firewall.state_payload(state, live).split("\n")
+    assert lines[0] == "*filter"
+    assert ":QOMUI-IN - [0:0]" in lines and ":QOMUI-ALLOW - [0:0]" in lines
+    assert ":INPUT DROP [0:0]" in lines
+    #duplicate jumps are replaced, a single one is kept and third-party rules are not touched
+    assert lines.count("-D INPUT -j QOMUI-IN") == 2
+    assert lines.count("-A INPUT -j QOMUI-IN") == 1
+    assert "-A OUTPUT -j QOMUI-OUT" not in lines and "-A FORWARD -j QOMUI-FWD" in lines
+    assert not any("OTHER" in l for l in lines)
+    assert "-A QOMUI-OUT -j ACCEPT" in lines
+
+def test_state_payload_keeps_allow_chain():
+    state = firewall.compile_state(firewall.chain_rules(firewall.validate_config(profile()), 0))
+    live = firewall.parse_save("*filter\n:QOMUI-ALLOW - [0:0]\n"
+                               "-A QOMUI-ALLOW -d 10.0.0.1/32 -j ACCEPT\nCOMMIT\n")
+    #declaring QOMUI-ALLOW would flush the addresses allowed at runtime
+    assert ":QOMUI-ALLOW - [0:0]" not in firewall.state_payload(state, live)
+
+def test_state_payload_off():
+    state = firewall.compile_state(firewall.chain_rules(firewall.validate_config(profile()), None))
+    live = firewall.parse_save("*filter\n:QOMUI-IN - [0:0]\n:QOMUI-ALLOW - [0:0]\n"
+                               "-A INPUT -j QOMUI-IN\nCOMMIT\n")
+    lines = firewall.state_payload(state, live).split("\n")
+    assert lines[1:-2] == [":INPUT ACCEPT [0:0]", ":OUTPUT ACCEPT [0:0]", ":FORWARD ACCEPT [0:0]",
+                           "-D INPUT -j QOMUI-IN", "-F QOMUI-IN", "-F QOMUI-ALLOW",
+                           "-X QOMUI-IN", "-X QOMUI-ALLOW"]
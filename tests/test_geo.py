@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+from qomui import geo
+
+def test_distance():
+    assert geo.distance((0, 0), (0, 0)) == 0
+    #one degree along the equator
+    assert geo.distance((0, 0), (0, 1)) == pytest.approx(111.19, abs=0.01)
+    assert geo.distance(geo.cities["berlin"], geo.cities["paris"]) == pytest.approx(878, abs=5)
+    assert geo.distance((0, 0), (0, 180)) == pytest.approx(geo.earth_radius * 3.14159265, abs=0.01)
+
+def test_parse_iso6709():
+    assert geo.parse_iso6709("+5230+01322") == pytest.approx((52.5, 13.3667), abs=1e-4)
+    assert geo.parse_iso6709("-334508+1511000") == pytest.approx((-33.7522, 151.1667), abs=1e-4)
+    assert geo.parse_iso6709("garbage") is None
+
+def test_locate(monkeypatch):
+    monkeypatch.setattr(geo, "timezone_coords", lambda: (1.0, 2.0))
+    assert geo.locate("48.1, 11.6") == (48.1, 11.6)
+    assert geo.locate(" Zürich ") == geo.cities["zürich"]
+    assert geo.locate("Germany") == geo.countries["germany"]
+    assert geo.locate("atlantis") == (1.0, 2.0)
+    assert geo.locate() == (1.0, 2.0)
+
+def test_distances():
+    servers = {"a" : {"city" : "Berlin", "country" : "Germany"},
+               "b" : {"city" : "Nowhere", "country" : "France"},
+               "c" : {"city" : "", "country" : "Atlantis"}
+               }
+    result = geo.distances(servers, geo.cities["berlin"])
+    assert result["a"] == 0
+    assert result["b"] == round(geo.distance(geo.cities["berlin"], geo.countries["france"]))
+    assert "c" not in result
+    assert geo.distances(servers, None) == {}
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import socket
+import struct
+from qomui import netlink
+
+def unpack_route(body):
+    fields = netlink.rtmsg.unpack_from(body)
+    return fields, netlink.parse_attrs(body[netlink.rtmsg.size:])
+
+def test_attr_padding():
+    data = netlink.attr(netlink.RTA_DST, b"\x01\x02\x03")
+    assert len(data) == 8
+    assert netlink.parse_attrs(data) == {netlink.RTA_DST : b"\x01\x02\x03"}
+
+def test_parse_prefix():
+    assert netlink.parse_prefix("default") == ("0.0.0.0", 0)
+    assert netlink.parse_prefix("10.8.0.0/24") == ("10.8.0.0", 24)
+    assert netlink.parse_prefix("10.8.0.1") == ("10.8.0.1", 32)
+
+def test_route_msg_add():
+    msg_type, flags, body = netlink.route_msg("add", "default", gateway="192.168.1.1", table=11)
+    assert msg_type == netlink.RTM_NEWROUTE
+    assert flags == netlink.NLM_F_CREATE | netlink.NLM_F_REPLACE
+    fields, attrs = unpack_route(body)
+    family, dst_len, src_len, tos, table, protocol, scope, rtype, rtflags = fields
+    assert (family, dst_len, table, scope, rtype) == (socket.AF_INET, 0, 11, netlink.RT_SCOPE_UNIVERSE, netlink.RTN_UNICAST)
+    assert attrs[netlink.RTA_TABLE] == struct.pack("=I", 11)
+    assert attrs[netlink.RTA_GATEWAY] == socket.inet_aton("192.168.1.1")
+    assert netlink.RTA_DST not in attrs
+
+def test_route_msg_link_scope():
+    body = netlink.route_msg("add", "10.8.0.0/24")[2]
+    fields, attrs = unpack_route(body)
+    assert fields[6] == netlink.RT_SCOPE_LINK
+    assert attrs[netlink.RTA_DST] == socket.inet_aton("10.8.0.0")
+    assert attrs[netlink.RTA_TABLE] == struct.pack("=I", netlink.RT_TABLE_MAIN)
+
+def test_route_msg_del_scope_nowhere():
+    msg_type, flags, body = netlink.route_msg("del", "default", table=300)
+    assert (msg_type, flags) == (netlink.RTM_DELROUTE, 0)
+    fields, attrs = unpack_route(body)
+    #tables above 255 only fit into RTA_TABLE
+    assert fields[4] == 0
+    assert fields[6] == netlink.RT_SCOPE_NOWHERE
+    assert attrs[netlink.RTA_TABLE] == struct.pack("=I", 300)
+
+def test_rule_msg():
+    msg_type, flags, body = netlink.rule_msg("add", 11, 11)
+    assert msg_type == netlink.RTM_NEWRULE
+    assert flags == netlink.NLM_F_CREATE | netlink.NLM_F_EXCL
+    fields, attrs = unpack_route(body)
+    assert fields[7] == netlink.FR_ACT_TO_TBL
+    assert attrs[netlink.FRA_FWMARK] == struct.pack("=I", 11)
+    assert netlink.rule_msg("del", 11, 11)[:2] == (netlink.RTM_DELRULE, 0)
+
+def test_parse_messages():
+    payload = b"\x01\x02\x03"
+    length = netlink.nlmsghdr.size + len(payload)
+    data = netlink.nlmsghdr.pack(length, netlink.NLMSG_DONE, 0, 7, 0) + payload + b"\0"
+    data += netlink.nlmsghdr.pack(netlink.nlmsghdr.size, netlink.NLMSG_ERROR, 0, 8, 0)
+    assert list(netlink.parse_messages(data)) == [(netlink.NLMSG_DONE, 7, payload), (netlink.NLMSG_ERROR, 8, b"")]
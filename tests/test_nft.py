@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+from qomui import nft
+
+def test_translate_match_and_verdict():
+    spec = ["-o", "tun+", "-p", "udp", "--dport", "1194", "-j", "ACCEPT"]
+    assert nft.translate(spec) == 'oifname "tun*" meta l4proto udp udp dport 1194 accept'
+
+def test_translate_negation_and_addresses():
+    assert nft.translate(["!", "-d", "10.0.0.0/8", "-j", "DROP"]) == "ip daddr != 10.0.0.0/8 drop"
+    assert nft.translate(["-s", "fe80::/10", "-j", "ACCEPT"]) == "ip6 saddr fe80::/10 accept"
+
+def test_translate_multiport_and_state():
+    spec = ["-p", "tcp", "-m", "multiport", "--dports", "80,443,8000:8080",
+            "-m", "state", "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"]
+    assert nft.translate(spec) == ("meta l4proto tcp tcp dport { 80, 443, 8000-8080 } "
+                                   "ct state established,related accept")
+
+def test_translate_masked_connmark():
+    assert nft.translate(["-j", "CONNMARK", "--set-xmark", "0xb/0xffff"]) == "ct mark set ct mark and 0xffff0000 or 0xb"
+    assert nft.translate(["-m", "connmark", "--mark", "0xb/0xffff"]) == "ct mark and 0xffff == 0xb counter"
+    assert nft.translate(["-j", "MARK", "--set-mark", "11"]) == "meta mark set 11"
+
+def test_translate_comment_and_tag():
+    spec = ["-m", "comment", "--comment", "qomui-acct default tx"]
+    assert nft.translate(spec) == 'counter comment "qomui-acct default tx"'
+    assert nft.translate(spec, tag="qomui-abc") == 'counter comment "qomui-abc"'
+
+def test_translate_unsupported():
+    with pytest.raises(ValueError):
+        nft.translate(["-m", "owner", "--uid-owner", "0", "-j", "ACCEPT"])
+    with pytest.raises(ValueError):
+        nft.translate(["--bogus", "1"])
+
+def test_rule_tag_ignores_order_and_host_prefix():
+    assert nft.rule_tag("filter", "OUTPUT", ["-d", "10.0.0.1/32", "-j", "ACCEPT"]) == \
+        nft.rule_tag("filter", "OUTPUT", ["-j", "ACCEPT", "-d", "10.0.0.1"])
+    assert nft.rule_tag("filter", "OUTPUT", ["-j", "ACCEPT"]) != nft.rule_tag("filter", "INPUT", ["-j", "ACCEPT"])
+
+def test_render_ruleset():
+    rules = [["-P", "OUTPUT", "DROP"],
+             ["-F"],
+             ["-A", "OUTPUT", "-o", "tun0", "-j", "ACCEPT"],
+             ["-I", "OUTPUT", "1", "-o", "lo", "-j", "ACCEPT"]
+             ]
+    rules_6 = [["-P", "OUTPUT", "DROP"]]
+    payload = nft.render_ruleset(rules, rules_6).split("\n")
+    assert payload[:3] == ["table inet qomui", "delete table inet qomui", "table inet qomui {"]
+    start = payload.index("    chain output {")
+    end = payload.index("    }", start)
+    assert payload[start+1:end] == [
+        "        type filter hook output priority 0; policy drop;",
+        '        meta nfproto ipv4 oifname "lo" accept',
+        "        jump qomui-allow",
+        "        ip daddr @qomui_servers accept",
+        "        ip6 daddr @qomui_servers6 accept",
+        '        meta nfproto ipv4 oifname "tun0" accept'
+        ]
+
+def test_render_ruleset_split_policy():
+    payload = nft.render_ruleset([["-P", "INPUT", "DROP"]], [["-P", "INPUT", "ACCEPT"]]).split("\n")
+    start = payload.index("    chain input {")
+    end = payload.index("    }", start)
+    assert payload[start+1] == "        type filter hook input priority 0; policy accept;"
+    assert payload[end-1] == "        meta nfproto ipv4 drop"
+
+def test_rule_tag_keeps_directions_apart():
+    assert nft.rule_tag("filter", "QOMUI-ALLOW", ["-s", "10.0.0.1", "-d", "10.0.0.2", "-j", "ACCEPT"]) != \
+        nft.rule_tag("filter", "QOMUI-ALLOW", ["-s", "10.0.0.2", "-d", "10.0.0.1", "-j", "ACCEPT"])
+
+def test_runtime_rules_survive_rebuild(monkeypatch):
+    monkeypatch.setattr(nft, "runtime_rules", {})
+    monkeypatch.setattr(nft, "list_chain", lambda chain: "")
+    payloads = []
+    monkeypatch.setattr(nft, "run_nft", lambda payload: payloads.append(payload) or True)
+    allow = ["-A", nft.allow_chain, "-d", "10.0.0.1", "-j", "ACCEPT"]
+    assert nft.add_rules([allow]) is True
+    tag = nft.rule_tag("filter", nft.allow_chain, allow[2:])
+    assert 'comment "%s"' %tag in payloads[0]
+
+    ruleset = nft.render_ruleset([["-P", "OUTPUT", "DROP"]], [])
+    chain = ruleset[ruleset.index("chain qomui-allow {"):]
+    assert 'meta nfproto ipv4 ip daddr 10.0.0.1 accept comment "%s"' %tag in chain.split("}")[0]
+
+    assert nft.add_rules([["-D"] + allow[1:]]) is True
+    assert nft.runtime_rules == {}
+    assert "10.0.0.1" not in nft.render_ruleset([], [])
+
+def test_runtime_rules_not_kept_when_rejected(monkeypatch):
+    monkeypatch.setattr(nft, "runtime_rules", {})
+    monkeypatch.setattr(nft, "list_chain", lambda chain: "")
+    monkeypatch.setattr(nft, "run_nft", lambda payload: False)
+    assert nft.add_rules([["-A", nft.allow_chain, "-d", "10.0.0.1", "-j", "ACCEPT"]]) is False
+    assert nft.runtime_rules == {}
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from qomui import probe
+
+def test_sample_stats():
+    stats = probe.sample_stats([20.0, 30.0, 25.0])
+    assert stats == {"median" : 25.0, "jitter" : 7.5, "loss" : 0.0, "ewma" : 25.0}
+
+def test_sample_stats_loss():
+    stats = probe.sample_stats([10.0, 999, 999])
+    assert stats["median"] == 10.0
+    assert stats["jitter"] == 0.0
+    assert stats["loss"] == 66.7
+
+def test_sample_stats_all_lost():
+    stats = probe.sample_stats([999, 999, 999], previous=[0, 50.0, 0, 0, 50.0])
+    assert stats == {"median" : 999.0, "jitter" : 0.0, "loss" : 100.0, "ewma" : 999.0}
+
+def test_sample_stats_ewma():
+    stats = probe.sample_stats([40.0], previous=[0, 10.0, 0.0, 0.0, 10.0])
+    assert stats["ewma"] == round(probe.ewma_alpha * 40.0 + (1 - probe.ewma_alpha) * 10.0, 3)
+    #unreachable or old style entries do not contribute
+    assert probe.sample_stats([40.0], previous=[0, 999, 100.0, 0.0, 999])["ewma"] == 40.0
+    assert probe.sample_stats([40.0], previous=[0, 10.0, 0.0])["ewma"] == 40.0
+
+def test_history_score():
+    assert probe.history_score([0, 20.0, 0.0, 1.0, 15.0]) == 15.0
+    assert probe.history_score([0, 20.0, 0.0]) == 20.0
+
+def test_stale_order():
+    now = probe.time.time()
+    history = {"a" : [now - 10, 20.0, 0.0], "b" : [now - 7200, 20.0, 0.0], "c" : [now - 4000, 20.0, 0.0]}
+    assert probe.stale(history, ["a", "b", "c", "d", "e"], rank={"e" : 1, "d" : 2}) == ["e", "d", "b", "c"]
+
+def test_schedule_budget_and_hot_servers():
+    now = probe.time.time()
+    server_dict = {k : {} for k in ("fav", "best", "cold", "fresh")}
+    history = {"fav" : [now - 600, 50.0, 0.0],
+               "best" : [now - 600, 10.0, 0.0],
+               "cold" : [now - 600, 100.0, 0.0],
+               "fresh" : [now, 30.0, 0.0],
+               "removed" : [0, 5.0, 0.0]
+               }
+    assert probe.schedule(history, server_dict, priority=["fav"], best=1) == ["best", "fav"]
+    assert probe.schedule(history, server_dict, priority=["fav"], best=1, budget=1) == ["best"]
+
+def test_probe_handshake_falls_back_after_one_reset(monkeypatch):
+    resets = []
+    monkeypatch.setattr(probe, "openvpn_reset", lambda ip, port, interface: resets.append(ip) or 999.0)
+    monkeypatch.setattr(probe, "ping", lambda ip, interface: 30.0)
+    monkeypatch.setattr(probe, "sample_interval", 0)
+    server_dict = {"s%s" %i : {"ip" : "10.0.0.%s" %i, "provider" : "Airvpn"} for i in range(5)}
+    endpoints = {k : (v["ip"], "UDP", "443") for k, v in server_dict.items()}
+    check = probe.Sweep(server_dict, "eth0", endpoints=endpoints)
+    check.prober = None
+    for k in sorted(server_dict):
+        assert check.probe(k, server_dict[k]["ip"]) == (k, [30.0] * probe.samples)
+    #one reset per server until the provider counts as tls-auth only
+    assert len(resets) == probe.silent_after
+
+def test_malformed_history_entries():
+    now = probe.time.time()
+    history = {"ok" : [now - 600, 10.0, 0.0, 1.0, 12.0], "short" : [now - 600], "empty" : [],
+               "text" : "20.0", "dict" : {"rtt" : 5}, "bad" : ["x", "y", 0.0]}
+    for k in ("short", "empty", "text", "dict", "bad"):
+        assert probe.history_score(history[k]) is None
+    server_dict = {k : {} for k in history}
+    assert probe.schedule(history, server_dict, best=1, hot=0, cold=3600) == \
+        ["ok", "bad", "dict", "empty", "text"]
+    assert probe.sample_stats([40.0], previous={"rtt" : 5})["ewma"] == 40.0
+
+def test_checksum():
+    packet = probe.icmp_echo.pack(8, 0, 0, 1, 1) + b"qomui"
+    packet = probe.icmp_echo.pack(8, 0, probe.checksum(packet), 1, 1) + b"qomui"
+    assert probe.checksum(packet) == 0
+
+def test_sweep_run(monkeypatch, tmp_path):
+    monkeypatch.setattr(probe, "can_bind", lambda interface: False)
+    monkeypatch.setattr(probe, "ping", lambda ip, interface: {"10.0.0.1" : 20.0}.get(ip, 999.0))
+    monkeypatch.setattr(probe, "sample_interval", 0)
+    server_dict = {"a" : {"ip" : "10.0.0.1"}, "b" : {"prim_ip" : "10.0.0.2"}, "c" : {"ip" : "10.0.0.3"}}
+    history = {}
+    results = []
+    sweep = probe.Sweep(server_dict, "eth0", keys=["a", "b"], history=history,
+                        history_file=str(tmp_path / "latency.json"))
+    sweep.run(results.append)
+    assert sorted((k, text, score) for k, text, score, stats in results) == \
+        [("a", "20.0 ms", 20.0), ("b", "N.A.", 999.0)]
+    assert history["a"][1:] == [20.0, 0.0, 0.0, 20.0]
+    assert history["b"][2] == 100.0
+    assert (tmp_path / "latency.json").exists()